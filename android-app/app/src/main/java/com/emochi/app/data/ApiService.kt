@@ -24,11 +24,12 @@ class ApiService(private val baseUrl: String = "http://10.0.2.2:8001") {
         }  
     }  
       
-    suspend fun sendMessage(chatId: String, text: String, provider: String? = null, modelHint: String? = null): MessageResponse {  
+    suspend fun sendMessage(chatId: String, text: String, provider: String? = null, modelHint: String? = null, clientMessageId: String = java.util.UUID.randomUUID().toString()): MessageResponse {  
         return try {  
             val response = client.post("$baseUrl/chat/$chatId/message") {  
                 contentType(ContentType.Application.Json)  
-                setBody(MessageRequest(text = text, provider = provider, model_hint = modelHint))  
+                header("Idempotency-Key", clientMessageId)  
+                setBody(MessageRequest(text = text, provider = provider, model_hint = modelHint, client_message_id = clientMessageId))  
             }  
             response.body()  
         } catch (e: Exception) {  
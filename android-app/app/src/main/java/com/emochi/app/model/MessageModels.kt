@@ -3,7 +3,7 @@ package com.emochi.app.model
 import kotlinx.serialization.Serializable  
   
 @Serializable  
-data class MessageRequest(val text: String, val provider: String? = null, val model_hint: String? = null)  
+data class MessageRequest(val text: String, val provider: String? = null, val model_hint: String? = null, val client_message_id: String? = null)  
   
 @Serializable  
 data class MessageResponse(val chat_id: String, val model: String, val reply: String, val emotion_hint: EmotionHint? = null)  
@@ -0,0 +1,165 @@
+import os
+import gzip
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+
+from metrics import record_storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived (
+    chat_id TEXT PRIMARY KEY,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    last_active REAL NOT NULL,
+    archived_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archived_segment ON archived (segment);
+CREATE INDEX IF NOT EXISTS archived_last_active ON archived (last_active);
+"""
+
+class ChatArchive:
+    # cold chats packed into append-only segment files, one gzip member per chat, found through a small SQLite index;
+    # thousands of idle chats cost a few files instead of a directory each. Rehydrated or expired chats leave dead
+    # bytes behind, which reclaim() squeezes out by copying the live members of sparse segments forward.
+    def __init__(self, root: str, segment_bytes: int) -> None:
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        # one reclaim at a time; it takes _lock only for the index reads and updates, never while copying
+        self._reclaim_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._segment: Optional[str] = None
+
+    def _index(self, create: bool = False) -> Optional[sqlite3.Connection]:
+        # nothing is created until the first chat is archived, so lookups for unknown chats stay read-only
+        if self._db is None:
+            path = os.path.join(self.root, "index.db")
+            if not create and not os.path.exists(path):
+                return None
+            os.makedirs(self.root, exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    def _segment_path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _new_segment(self) -> str:
+        name = f"seg-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.gz"
+        open(self._segment_path(name), "ab").close()
+        return name
+
+    def _writable_segment(self) -> str:
+        if self._segment is None or os.path.getsize(self._segment_path(self._segment)) >= self.segment_bytes:
+            self._segment = self._new_segment()
+        return self._segment
+
+    def _append(self, payload: bytes) -> Tuple[str, int]:
+        segment = self._writable_segment()
+        with open(self._segment_path(segment), "ab") as f:
+            offset = f.tell()
+            f.write(payload)
+            f.flush()
+            # the caller deletes the chat's directory next, so the bytes must be durable first
+            os.fsync(f.fileno())
+        record_storage("write", len(payload))
+        return segment, offset
+
+    def put(self, chat_id: str, record: Dict[str, Any], last_active: float) -> None:
+        payload = gzip.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"), compresslevel=6)
+        with self._lock:
+            db = self._index(create=True)
+            segment, offset = self._append(payload)
+            db.execute("INSERT OR REPLACE INTO archived (chat_id, segment, offset, length, last_active, archived_at) VALUES (?, ?, ?, ?, ?, ?)", (chat_id, segment, offset, len(payload), last_active, time.time()))
+
+    def load(self, chat_id: str) -> Optional[Tuple[Dict[str, Any], float]]:
+        # (record, last_active), or None when the chat is not archived
+        with self._lock:
+            db = self._index()
+            row = db.execute("SELECT segment, offset, length, last_active FROM archived WHERE chat_id = ?", (chat_id,)).fetchone() if db else None
+            if row is None:
+                return None
+            segment, offset, length, last_active = row
+            # read under the lock so reclaim() cannot move the member mid-read
+            with open(self._segment_path(segment), "rb") as f:
+                f.seek(offset)
+                payload = f.read(length)
+        record_storage("read", len(payload))
+        return json.loads(gzip.decompress(payload)), last_active
+
+    def drop(self, chat_id: str) -> None:
+        with self._lock:
+            db = self._index()
+            if db is not None:
+                db.execute("DELETE FROM archived WHERE chat_id = ?", (chat_id,))
+
+    def expire(self, before: float) -> int:
+        # retention: forget archived chats whose last activity is older than `before`; reclaim() frees the bytes
+        with self._lock:
+            db = self._index()
+            if db is None:
+                return 0
+            return db.execute("DELETE FROM archived WHERE last_active < ?", (before,)).rowcount
+
+    def chat_ids(self) -> List[str]:
+        with self._lock:
+            db = self._index()
+            return [r[0] for r in db.execute("SELECT chat_id FROM archived ORDER BY chat_id")] if db else []
+
+    def _copy(self, src_path: str, rows: List[Tuple[str, int, int]], target: Optional[str]) -> Tuple[str, List[Tuple[str, int, str, int]]]:
+        # copies members into reclaim's own output segment with one fsync for the whole batch;
+        # returns the segment written and (segment, new offset, chat_id, old offset) per member
+        if target is None or os.path.getsize(self._segment_path(target)) >= self.segment_bytes:
+            target = self._new_segment()
+        moved, written = [], 0
+        with open(src_path, "rb") as src, open(self._segment_path(target), "ab") as out:
+            for chat_id, offset, length in rows:
+                src.seek(offset)
+                moved.append((target, out.tell(), chat_id, offset))
+                written += out.write(src.read(length))
+            out.flush()
+            os.fsync(out.fileno())
+        record_storage("write", written)
+        return target, moved
+
+    def reclaim(self, min_live_ratio: float = 0.5, batch: int = 256) -> int:
+        # deletes segments with no live chats and rewrites those below min_live_ratio; returns bytes freed.
+        # members are copied outside _lock in batches, so loads (and so rehydration on a request) only ever wait for
+        # a short index update, never for the copying
+        with self._reclaim_lock:
+            with self._lock:
+                db = self._index()
+                if db is None:
+                    return 0
+                live = dict(db.execute("SELECT segment, SUM(length) FROM archived GROUP BY segment").fetchall())
+                sparse = []
+                for name in sorted(os.listdir(self.root)):
+                    if not (name.startswith("seg-") and name.endswith(".gz")) or name == self._segment:
+                        continue
+                    size = os.path.getsize(self._segment_path(name))
+                    if not (name in live and live[name] >= size * min_live_ratio):
+                        sparse.append((name, size))
+            freed, target = 0, None
+            for name, size in sparse:
+                path = self._segment_path(name)
+                # nothing is appended to a closed segment, so its members can only be dropped or re-put from here on
+                with self._lock:
+                    rows = db.execute("SELECT chat_id, offset, length FROM archived WHERE segment = ?", (name,)).fetchall()
+                for i in range(0, len(rows), batch):
+                    target, moved = self._copy(path, rows[i:i + batch], target)
+                    with self._lock:
+                        db.execute("BEGIN IMMEDIATE")
+                        # a chat rehydrated or re-archived meanwhile no longer points here and keeps its new location
+                        db.executemany("UPDATE archived SET segment = ?, offset = ? WHERE chat_id = ? AND segment = ? AND offset = ?", [(seg, off, chat_id, name, old) for seg, off, chat_id, old in moved])
+                        db.execute("COMMIT")
+                with self._lock:
+                    os.remove(path)
+                freed += size - sum(r[2] for r in rows)
+            return freed
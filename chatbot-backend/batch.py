@@ -0,0 +1,256 @@
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Callable, Iterable, Iterator, Set, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import storage
+import state_cache
+import llm_backends
+from rp_engine import generate_reply, set_model, set_settings, PRIVATE_KEYS
+from postprocess import pipeline
+from scheduler import parse_limits, Overloaded
+
+logger = logging.getLogger(__name__)
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_PROVIDER_CONCURRENCY = os.getenv("BATCH_PROVIDER_CONCURRENCY", "ollama=2,openai=8")
+BATCH_OVERLOAD_RETRIES = int(os.getenv("BATCH_OVERLOAD_RETRIES", "5"))
+CHECKPOINT_DIR = os.getenv("BATCH_CHECKPOINT_DIR", os.path.join(storage.BASE_DIR, "checkpoints"))
+
+# the persona-defining part of a chat; replays copy these and regenerate everything else
+PERSONA_KEYS = ("model", "intro", "personality", "welcome", "tags", "gender")
+
+_CHECKPOINT_NAME_RE = re.compile(r"^[A-Za-z0-9_.\-]{1,64}$")
+
+Event = Dict[str, Any]
+
+def checkpoint_path(name: str) -> str:
+    if not _CHECKPOINT_NAME_RE.match(name or ""):
+        raise ValueError(f"Invalid checkpoint name: {name}")
+    return os.path.join(CHECKPOINT_DIR, name + ".jsonl")
+
+class Checkpoint:
+    # append-only record of finished job ids; rerunning the same jobs with the same checkpoint skips them
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.done: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)["id"])
+                    except (ValueError, KeyError):
+                        continue
+
+    def mark(self, job_id: str, chat_id: str) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": job_id, "chat_id": chat_id, "time": time.time()}) + "\n")
+        self.done.add(job_id)
+
+def job_ids(jobs: Iterable[Dict[str, Any]]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # stable across runs for the same input: explicit "id", else chat id plus the job's position within that chat
+    seen: Dict[str, int] = {}
+    for job in jobs:
+        n = seen[job["chat_id"]] = seen.get(job["chat_id"], -1) + 1
+        yield str(job.get("id") or f"{job['chat_id']}#{n}"), job
+
+def validate_job(job: Any) -> None:
+    if not isinstance(job, dict) or not isinstance(job.get("text"), str) or not storage.valid_chat_id(job.get("chat_id")):
+        raise ValueError(f"Invalid batch job: {job!r:.200}")
+    if job.get("provider"):
+        llm_backends.resolve_provider(job["provider"])
+
+async def _generate_with_retry(chat_id: str, job: Dict[str, Any]) -> Dict[str, Any]:
+    # a batch shares the server's admission control; back off as told instead of failing the chat
+    for attempt in range(BATCH_OVERLOAD_RETRIES + 1):
+        try:
+            return await generate_reply(chat_id, job["text"], provider_override=job.get("provider"), model_hint=job.get("model_hint"))
+        except Overloaded as e:
+            if attempt == BATCH_OVERLOAD_RETRIES:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+async def run_batch(jobs: List[Dict[str, Any]], checkpoint: Optional[Checkpoint] = None, limits: Optional[Dict[str, int]] = None, default_limit: int = BATCH_CONCURRENCY, on_event: Optional[Callable[[Event], None]] = None) -> Dict[str, Any]:
+    # jobs for one chat run in input order; chats run concurrently, bounded by a semaphore per resolved provider
+    for job in jobs:
+        validate_job(job)
+    limits = {**parse_limits(BATCH_PROVIDER_CONCURRENCY), **(limits or {})}
+    semaphores: Dict[str, asyncio.Semaphore] = {}
+    # skipped: already in the checkpoint; blocked: not attempted because an earlier turn of the same chat failed
+    stats = {"total": len(jobs), "done": 0, "failed": 0, "skipped": 0, "blocked": 0}
+    started = time.monotonic()
+    emit = on_event or (lambda event: None)
+
+    by_chat: "OrderedDict[str, List[Tuple[str, Dict[str, Any]]]]" = OrderedDict()
+    for jid, job in job_ids(jobs):
+        if checkpoint is not None and jid in checkpoint.done:
+            stats["skipped"] += 1
+            continue
+        by_chat.setdefault(job["chat_id"], []).append((jid, job))
+
+    def progress() -> Event:
+        elapsed = time.monotonic() - started
+        return {"type": "progress", **stats, "elapsed": round(elapsed, 2), "rate": round(stats["done"] / elapsed, 2) if elapsed else 0.0}
+
+    async def run_chat(chat_id: str, items: List[Tuple[str, Dict[str, Any]]]) -> None:
+        for jid, job in items:
+            settings = job.get("settings") or {}
+            if settings.get("model"):
+                await state_cache.offload(set_model, chat_id, settings["model"])
+            if any(k in settings for k in PERSONA_KEYS if k != "model"):
+                await state_cache.offload(set_settings, chat_id, **{k: settings.get(k) for k in PERSONA_KEYS if k != "model"})
+            meta = await state_cache.offload(state_cache.load_meta, chat_id)
+            provider = llm_backends.backend_provider(llm_backends.resolve_provider(job.get("provider"), meta.get("model")))
+            sem = semaphores.setdefault(provider, asyncio.Semaphore(limits.get(provider, default_limit)))
+            async with sem:
+                try:
+                    result = await _generate_with_retry(chat_id, job)
+                    error = None if result.get("outcome") == "ok" else result.get("reply")
+                except Exception as e:
+                    logger.exception("Batch job %s failed", jid)
+                    result, error = None, str(e)
+            if error is not None:
+                stats["failed"] += 1
+                emit({"type": "error", "id": jid, "chat_id": chat_id, "error": error})
+                # later turns depend on this one; stop the chat here so a resume replays it in order
+                stats["blocked"] += len(items) - items.index((jid, job)) - 1
+                break
+            stats["done"] += 1
+            # the reply is saved in the background; only checkpoint once it is on record
+            await pipeline.wait(chat_id)
+            if checkpoint is not None:
+                checkpoint.mark(jid, chat_id)
+            emit({"type": "result", "id": jid, "chat_id": chat_id, "reply": result["reply"], "emotion_hint": result["emotion_hint"]})
+            emit(progress())
+
+    await asyncio.gather(*(run_chat(chat_id, items) for chat_id, items in by_chat.items()))
+    await pipeline.drain()
+    summary = progress()
+    summary["type"] = "done"
+    emit(summary)
+    return summary
+
+def export_chats(chat_ids: Optional[List[str]] = None) -> Iterator[str]:
+    # sync generator of NDJSON lines straight from storage; the write-back cache is flushed first so nothing is missed
+    state_cache.flush_all()
+    for chat_id in chat_ids or storage.list_chats():
+        st = storage.read_state(chat_id)
+        yield json.dumps({"chat_id": chat_id, "state": {k: v for k, v in st.items() if k not in PRIVATE_KEYS}}, ensure_ascii=False) + "\n"
+
+def import_line(line: str) -> Optional[str]:
+    # returns the imported chat id, None for blank lines; raises ValueError for bad records
+    line = line.strip()
+    if not line:
+        return None
+    record = json.loads(line)
+    chat_id, st = (record.get("chat_id"), record.get("state")) if isinstance(record, dict) else (None, None)
+    if not storage.valid_chat_id(chat_id) or not isinstance(st, dict) or not isinstance(st.get("messages", []), list) or not all(isinstance(m, dict) for m in st.get("messages", [])):
+        raise ValueError(f"Invalid chat record: {line[:200]}")
+    st = {k: v for k, v in st.items() if k not in PRIVATE_KEYS}
+    st["chat_id"] = chat_id
+    st.setdefault("messages", [])
+    state_cache.replace_state(chat_id, st)
+    return chat_id
+
+def replay_jobs(export_lines: Iterable[str], prefix: str) -> List[Dict[str, Any]]:
+    # re-run every exported chat's user turns into "<prefix><chat_id>" under its current persona settings
+    jobs = []
+    for line in export_lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        st = record["state"]
+        settings = {k: st[k] for k in PERSONA_KEYS if k in st}
+        first = True
+        for m in st.get("messages", []):
+            if m.get("role") != "user":
+                continue
+            job = {"chat_id": prefix + record["chat_id"], "text": m.get("content", "")}
+            if first:
+                job["settings"] = settings
+                first = False
+            jobs.append(job)
+    return jobs
+
+def read_jobs(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Run generate_reply over many chats with per-provider concurrency limits and a resumable checkpoint")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    gen = sub.add_parser("generate", help="run jobs from an NDJSON file of {chat_id, text[, provider, model_hint, settings, id]}")
+    gen.add_argument("jobs")
+    rep = sub.add_parser("replay", help="replay the user turns of an export file into new chats")
+    rep.add_argument("export")
+    rep.add_argument("--into", default="replay-", help="prefix for the replayed chat ids")
+    for p in (gen, rep):
+        p.add_argument("--checkpoint", default=None, help="checkpoint file; rerun with the same file to resume")
+        p.add_argument("--concurrency", default=None, help="per-provider limits, e.g. ollama=2,openai=16")
+        p.add_argument("--default-concurrency", type=int, default=BATCH_CONCURRENCY)
+        p.add_argument("--results", default=None, help="write result/error events as NDJSON to this file")
+    exp = sub.add_parser("export", help="write chats as NDJSON to stdout")
+    exp.add_argument("chat_ids", nargs="*")
+    imp = sub.add_parser("import", help="load chats from an NDJSON export")
+    imp.add_argument("file")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.cmd == "export":
+        for line in export_chats(args.chat_ids or None):
+            sys.stdout.write(line)
+        return
+    if args.cmd == "import":
+        imported = 0
+        with open(args.file, "r", encoding="utf-8") as f:
+            for line in f:
+                imported += import_line(line) is not None
+        state_cache.shutdown()
+        print(f"imported {imported} chat(s)")
+        return
+
+    if args.cmd == "replay":
+        with open(args.export, "r", encoding="utf-8") as f:
+            jobs = replay_jobs(f, args.into)
+    else:
+        jobs = read_jobs(args.jobs)
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+    results = open(args.results, "a", encoding="utf-8") if args.results else None
+    last_report = [0.0]
+
+    def on_event(event: Event) -> None:
+        if event["type"] in ("result", "error") and results is not None:
+            results.write(json.dumps(event, ensure_ascii=False) + "\n")
+        if event["type"] == "error":
+            print(f"\nerror {event['id']}: {event['error']}", file=sys.stderr)
+        if event["type"] in ("progress", "done") and (event["type"] == "done" or time.monotonic() - last_report[0] >= 1):
+            last_report[0] = time.monotonic()
+            print(f"\r{event['done']}/{event['total']} done, {event['failed']} failed, {event['blocked']} blocked, {event['skipped']} skipped, {event['rate']}/s", end="\n" if event["type"] == "done" else "", file=sys.stderr, flush=True)
+
+    async def go() -> Dict[str, Any]:
+        try:
+            return await run_batch(jobs, checkpoint, parse_limits(args.concurrency), args.default_concurrency, on_event)
+        finally:
+            await llm_backends.aclose()
+
+    try:
+        summary = asyncio.run(go())
+    finally:
+        state_cache.shutdown()
+        if results is not None:
+            results.close()
+    sys.exit(1 if summary["failed"] or summary["blocked"] else 0)
+
+if __name__ == "__main__":
+    main()
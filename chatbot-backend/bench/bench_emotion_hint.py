@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import random
+import argparse
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from emotion_hint import TRIGGERS, score_triggers, score_triggers_batch
+
+FILLER = ["the", "you", "know", "now", "shot", "hotel", "she", "leans", "in", "slowly", "her", "eyes", "soft", "light", "room", "voice",
+          "quiet", "a", "and", "of", "to", "at", "into", "warm", "gentle", "smiles", "*she", "glances", "away*", "nothing", "another"]
+PHRASES = sorted({w for words in TRIGGERS.values() for w in words})
+
+def legacy_score_triggers(text: str) -> Dict[str, int]:
+    # the original per-phrase substring scan, kept verbatim for comparison
+    t = (text or "").lower()
+    scores = {k: 0 for k in TRIGGERS}
+    for k, words in TRIGGERS.items():
+        for w in words:
+            if w in t:
+                scores[k] += max(1, len(w) // 3)
+    return scores
+
+def make_corpus(n: int, words_per_message: int, trigger_rate: float, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    def word() -> str:
+        return rng.choice(PHRASES) if rng.random() < trigger_rate else rng.choice(FILLER)
+    return [" ".join(word() for _ in range(rng.randint(words_per_message // 2, words_per_message * 2))) for _ in range(n)]
+
+def timed(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark emotion_hint trigger scoring against the legacy substring scan")
+    ap.add_argument("--messages", type=int, default=5000)
+    ap.add_argument("--words", type=int, default=60, help="average words per message")
+    ap.add_argument("--trigger-rate", type=float, default=0.05, help="fraction of words that are trigger phrases")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    corpus = make_corpus(args.messages, args.words, args.trigger_rate, args.seed)
+    legacy = timed(lambda: [legacy_score_triggers(t) for t in corpus], args.repeat)
+    compiled = timed(lambda: [score_triggers(t) for t in corpus], args.repeat)
+    batch = timed(lambda: score_triggers_batch(corpus), args.repeat)
+
+    differing = sum(1 for t in corpus if legacy_score_triggers(t) != score_triggers(t))
+    print(f"{args.messages} messages, ~{args.words} words each, trigger rate {args.trigger_rate}, best of {args.repeat}")
+    print(f"{'legacy substring scan':<24}{legacy * 1000:>10.1f} ms  {args.messages / legacy:>12.0f} msg/s")
+    print(f"{'compiled score_triggers':<24}{compiled * 1000:>10.1f} ms  {args.messages / compiled:>12.0f} msg/s  x{legacy / compiled:.2f}")
+    print(f"{'score_triggers_batch':<24}{batch * 1000:>10.1f} ms  {args.messages / batch:>12.0f} msg/s  x{legacy / batch:.2f}")
+    print(f"messages scored differently from legacy (word-boundary fixes such as 'no' in 'know'): {differing}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import httpx
+
+TAGS = ["Flirty", "Romantic", "Dominant", "Submissive", "Seductive", "Taboo", "Dark Romance", "Tsundere", "Yandere", "Bratty", "Demon", "Cold"]
+LINES = ["hey, I missed you", "you look nervous, what's wrong?", "tell me about the storm last night", "I'm sorry I left without saying goodbye",
+         "do you trust me?", "let's get out of here", "why are you blushing?", "I brought you coffee", "you're not angry, are you?", "stay a little longer"]
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest-rank
+    idx = min(len(sorted_values) - 1, max(0, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    stages = {}
+    for part in header.split(","):
+        name, _, rest = part.strip().partition(";")
+        for param in rest.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur" and name:
+                stages[name] = float(value)
+    return stages
+
+def parse_mix(spec: str) -> List[Tuple[str, int]]:
+    mix = []
+    for item in spec.split(","):
+        op, _, weight = item.partition("=")
+        if op not in ("message", "state", "settings"):
+            raise SystemExit(f"unknown operation in --mix: {op}")
+        mix.append((op, int(weight or 1)))
+    return mix
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.statuses: Dict[int, int] = defaultdict(int)
+        self.stages: Dict[str, List[float]] = defaultdict(list)
+
+    def add(self, op: str, ms: float, status: int, timing: str = "") -> None:
+        self.latency[op].append(ms)
+        self.statuses[status] += 1
+        if status >= 400:
+            self.errors[op] += 1
+        for name, dur in parse_server_timing(timing).items() if timing else ():
+            self.stages[name].append(dur)
+
+async def one_request(client: httpx.AsyncClient, op: str, chat_id: str, rng: random.Random, args: argparse.Namespace, rec: Recorder) -> None:
+    start = time.perf_counter()
+    try:
+        if op == "message":
+            body = {"text": rng.choice(LINES)}
+            if args.provider:
+                body["provider"] = args.provider
+            r = await client.post(f"/chat/{chat_id}/message", json=body)
+        elif op == "state":
+            r = await client.get(f"/chat/{chat_id}/state")
+        else:
+            r = await client.post(f"/chat/{chat_id}/settings", json={"tags": rng.sample(TAGS, 2), "intro": f"bench intro {rng.randint(0, 9)}"})
+        status, timing = r.status_code, r.headers.get("server-timing", "")
+    except httpx.HTTPError:
+        status, timing = 599, ""
+    rec.add(op, (time.perf_counter() - start) * 1000, status, timing)
+
+async def run(args: argparse.Namespace) -> Tuple[Recorder, float]:
+    rng = random.Random(args.seed)
+    ops, weights = zip(*parse_mix(args.mix))
+    chats = [f"{args.chat_prefix}-{i}" for i in range(args.chats)]
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        if args.warmup:
+            await asyncio.gather(*(one_request(client, "state", c, rng, args, Recorder()) for c in chats[:args.concurrency]))
+        rec = Recorder()
+        remaining = args.requests
+        deadline = time.monotonic() + args.duration if args.duration else None
+
+        async def worker() -> None:
+            nonlocal remaining
+            while (remaining > 0) if deadline is None else (time.monotonic() < deadline):
+                remaining -= 1
+                await one_request(client, rng.choices(ops, weights)[0], rng.choice(chats), rng, args, rec)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        return rec, time.perf_counter() - start
+
+def report(rec: Recorder, elapsed: float, args: argparse.Namespace) -> Dict[str, object]:
+    total = sum(len(v) for v in rec.latency.values())
+    out = {"concurrency": args.concurrency, "chats": args.chats, "requests": total, "seconds": round(elapsed, 3), "rps": round(total / elapsed, 1) if elapsed else 0.0,
+           "status": dict(sorted(rec.statuses.items())), "endpoints": {}, "stages": {}}
+    for op, values in sorted(rec.latency.items()):
+        v = sorted(values)
+        out["endpoints"][op] = {"count": len(v), "errors": rec.errors[op], "rps": round(len(v) / elapsed, 1), "mean": round(sum(v) / len(v), 2),
+                                "p50": round(percentile(v, 50), 2), "p95": round(percentile(v, 95), 2), "p99": round(percentile(v, 99), 2), "max": round(v[-1], 2)}
+    for name, values in sorted(rec.stages.items()):
+        v = sorted(values)
+        out["stages"][name] = {"count": len(v), "mean": round(sum(v) / len(v), 3), "p50": round(percentile(v, 50), 3), "p95": round(percentile(v, 95), 3), "p99": round(percentile(v, 99), 3)}
+    return out
+
+def print_report(out: Dict[str, object]) -> None:
+    print(f"{out['requests']} requests in {out['seconds']}s at concurrency {out['concurrency']} over {out['chats']} chats: {out['rps']} req/s  status {out['status']}")
+    print(f"\n{'endpoint':<10}{'count':>8}{'errors':>8}{'req/s':>9}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+    for op, s in out["endpoints"].items():
+        print(f"{op:<10}{s['count']:>8}{s['errors']:>8}{s['rps']:>9}{s['mean']:>10}{s['p50']:>10}{s['p95']:>10}{s['p99']:>10}{s['max']:>10}")
+    if out["stages"]:
+        print(f"\n{'stage':<10}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}  (ms, from Server-Timing on /message)")
+        for name, s in out["stages"].items():
+            print(f"{name:<10}{s['count']:>8}{s['mean']:>10}{s['p50']:>10}{s['p95']:>10}{s['p99']:>10}")
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Drive /chat/{id}/message, /state and /settings at a fixed concurrency and report latency percentiles, "
+                                             "throughput and per-stage server costs. Start bench/stub_llm.py and point the backend at it first.")
+    ap.add_argument("--base-url", default="http://127.0.0.1:8001")
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--requests", type=int, default=1000, help="total requests (ignored with --duration)")
+    ap.add_argument("--duration", type=float, default=0, help="run for this many seconds instead of a fixed request count")
+    ap.add_argument("--chats", type=int, default=200, help="number of distinct chat ids")
+    ap.add_argument("--chat-prefix", default="bench")
+    ap.add_argument("--mix", default="message=6,state=3,settings=1", help="weighted operation mix")
+    ap.add_argument("--provider", default=None, help="provider override sent with /message")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--no-warmup", dest="warmup", action="store_false")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", action="store_true", help="print the report as JSON for run-to-run diffs")
+    args = ap.parse_args()
+    rec, elapsed = asyncio.run(run(args))
+    out = report(rec, elapsed, args)
+    if args.json:
+        json.dump(out, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from typing import Callable, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TAGS = ["Flirty", "Romantic", "Dominant", "Submissive", "Seductive", "Taboo", "Dark Romance", "Tsundere", "Yandere", "Bratty", "Demon", "Cold"]
+MODELS = ["Vanilla", "Vanilla Short", "Strawberry", "Chocolate", "Blueberry", "Sage"]
+USER_LINES = ["I missed you so much, please stay", "don't touch me, I'm angry at you", "why are you blushing? you look cute",
+              "I'm sorry, I was jealous and I lied", "let's go somewhere quiet tonight", "you know I trust you, right?"]
+BOT_LINES = ["*she leans closer, voice soft* I never left. I was waiting for you the whole time.",
+             "*turns away, arms crossed* It's not like I care what you do... idiot.",
+             "*smiles slowly, eyes dark* You're mine. Nobody else gets to look at you like that."]
+
+def measure(fn: Callable[[int], None], n: int, repeat: int) -> float:
+    # best-of-repeat seconds per operation; fn(i) performs the i-th operation
+    best = float("inf")
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(n):
+            fn(r * n + i)
+        best = min(best, time.perf_counter() - start)
+    return best / n
+
+def bench_storage(n: int, chats: int, repeat: int) -> Dict[str, float]:
+    import storage
+    import state_cache
+    results = {}
+    results["storage.append_message"] = measure(lambda i: storage.append_message(f"micro-file-{i % chats}", "user", USER_LINES[i % len(USER_LINES)]), n, repeat)
+    results["storage.load_state"] = measure(lambda i: storage.load_state(f"micro-file-{i % chats}"), n, repeat)
+    results["state_cache.append_message"] = measure(lambda i: state_cache.append_message(f"micro-cache-{i % chats}", "user", USER_LINES[i % len(USER_LINES)]), n, repeat)
+    start = time.perf_counter()
+    state_cache.flush_all()
+    results["state_cache.flush_all (per chat)"] = (time.perf_counter() - start) / chats
+    results["state_cache.load_state"] = measure(lambda i: state_cache.load_state(f"micro-cache-{i % chats}"), n, repeat)
+    return results
+
+def bench_engine(n: int, repeat: int) -> Dict[str, float]:
+    from persona import compile_profile
+    from rp_engine import build_system_prompt
+    rng = random.Random(3)
+    states = [{"tags": rng.sample(TAGS, 3), "intro": f"intro {i}", "personality": "shy but curious", "gender": "female", "welcome": "hi"} for i in range(64)]
+    results = {}
+    def cold(i: int) -> None:
+        compile_profile.cache_clear()
+        build_system_prompt(states[i % len(states)], MODELS[i % len(MODELS)])
+    results["build_system_prompt (cold)"] = measure(cold, n, repeat)
+    results["build_system_prompt (cached)"] = measure(lambda i: build_system_prompt(states[i % len(states)], MODELS[i % len(MODELS)]), n, repeat)
+    return results
+
+def bench_emotion(n: int, repeat: int) -> Dict[str, float]:
+    from emotion_hint import score_triggers, build_emotion_hint
+    from tag_personalities import tag_flags
+    texts = [u + " " + b for u in USER_LINES for b in BOT_LINES]
+    tags = ["Tsundere", "Yandere"]
+    flags = tag_flags(tuple(tags))
+    results = {}
+    results["score_triggers"] = measure(lambda i: score_triggers(texts[i % len(texts)]), n, repeat)
+    results["build_emotion_hint"] = measure(lambda i: build_emotion_hint(None, USER_LINES[i % len(USER_LINES)], BOT_LINES[i % len(BOT_LINES)], tags=tags, emotion_state={"attraction": 2}, flags=flags), n, repeat)
+    return results
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Microbenchmarks for storage, prompt build and emotion scoring; use --json and diff runs to compare changes")
+    ap.add_argument("-n", type=int, default=2000, help="operations per measurement")
+    ap.add_argument("--chats", type=int, default=50, help="distinct chat ids for the storage benchmarks")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--only", choices=["storage", "engine", "emotion"], action="append", help="run only these groups")
+    ap.add_argument("--data-dir", default=None, help="RP_DATA_DIR for storage benchmarks (default: a fresh temp dir)")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+    # must be set before storage is imported; never benchmark against the real rp_data
+    os.environ["RP_DATA_DIR"] = args.data_dir or tempfile.mkdtemp(prefix="emochi-bench-")
+    groups = args.only or ["storage", "engine", "emotion"]
+    results: Dict[str, float] = {}
+    if "storage" in groups:
+        results.update(bench_storage(args.n, args.chats, args.repeat))
+    if "engine" in groups:
+        results.update(bench_engine(args.n, args.repeat))
+    if "emotion" in groups:
+        results.update(bench_emotion(args.n, args.repeat))
+    if args.json:
+        json.dump({"n": args.n, "repeat": args.repeat, "us_per_op": {k: round(v * 1e6, 3) for k, v in results.items()}}, sys.stdout, indent=2)
+        print()
+        return
+    print(f"best of {args.repeat}, {args.n} ops each, data dir {os.environ['RP_DATA_DIR']}")
+    for name, sec in results.items():
+        print(f"{name:<34}{sec * 1e6:>12.2f} us/op{1 / sec:>14.0f} ops/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from typing import Dict, Any, AsyncIterator
+
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse
+
+WORDS = ["she", "leans", "closer", "her", "voice", "soft", "and", "warm", "the", "rain", "taps", "against", "window", "*smiles*", "you", "know",
+         "I", "missed", "this", "quiet", "light", "slowly", "turns", "away", "then", "back", "again"]
+
+class StubConfig:
+    latency_ms = 200.0
+    tokens_per_sec = 50.0
+    reply_tokens = 120
+    failure_rate = 0.0
+    seed = None
+
+cfg = StubConfig()
+rng = random.Random()
+app = FastAPI(title="Emochi stub LLM provider")
+
+def _tokens(n: int) -> list:
+    return [rng.choice(WORDS) + " " for _ in range(n)]
+
+async def _maybe_fail() -> None:
+    await asyncio.sleep(cfg.latency_ms / 1000)
+    if cfg.failure_rate and rng.random() < cfg.failure_rate:
+        raise HTTPException(status_code=503, detail="injected failure")
+
+async def _paced(tokens: list) -> AsyncIterator[str]:
+    delay = 1.0 / cfg.tokens_per_sec if cfg.tokens_per_sec > 0 else 0
+    for tok in tokens:
+        if delay:
+            await asyncio.sleep(delay)
+        yield tok
+
+def _prompt_tokens(body: Dict[str, Any]) -> int:
+    text = body.get("prompt") or " ".join(m.get("content", "") for m in body.get("messages", []))
+    return len(text) // 4 + 1
+
+def _reply_len(body: Dict[str, Any]) -> int:
+    limit = (body.get("options") or {}).get("num_predict") or body.get("max_tokens") or cfg.reply_tokens
+    return max(1, min(cfg.reply_tokens, int(limit)))
+
+@app.post("/api/generate")
+async def ollama_generate(request: Request):
+    body = await request.json()
+    await _maybe_fail()
+    tokens = _tokens(_reply_len(body))
+    if body.get("stream", True):
+        async def lines():
+            async for tok in _paced(tokens):
+                yield json.dumps({"model": body.get("model"), "response": tok, "done": False}) + "\n"
+            yield json.dumps({"model": body.get("model"), "response": "", "done": True, "context": [1, 2, 3], "prompt_eval_count": _prompt_tokens(body), "eval_count": len(tokens)}) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    text = "".join([tok async for tok in _paced(tokens)])
+    return {"model": body.get("model"), "response": text, "done": True, "context": [1, 2, 3], "prompt_eval_count": _prompt_tokens(body), "eval_count": len(tokens)}
+
+@app.post("/api/chat")
+async def ollama_chat(request: Request):
+    body = await request.json()
+    await _maybe_fail()
+    tokens = _tokens(_reply_len(body))
+    if body.get("stream", True):
+        async def lines():
+            async for tok in _paced(tokens):
+                yield json.dumps({"model": body.get("model"), "message": {"role": "assistant", "content": tok}, "done": False}) + "\n"
+            yield json.dumps({"model": body.get("model"), "message": {"role": "assistant", "content": ""}, "done": True, "prompt_eval_count": _prompt_tokens(body), "eval_count": len(tokens)}) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    text = "".join([tok async for tok in _paced(tokens)])
+    return {"model": body.get("model"), "message": {"role": "assistant", "content": text}, "done": True, "prompt_eval_count": _prompt_tokens(body), "eval_count": len(tokens)}
+
+@app.post("/v1/chat/completions")
+async def openai_chat(request: Request):
+    body = await request.json()
+    await _maybe_fail()
+    tokens = _tokens(_reply_len(body))
+    cid, created, model = f"chatcmpl-{uuid.uuid4().hex}", int(time.time()), body.get("model", "stub")
+    if body.get("stream"):
+        async def events():
+            async for tok in _paced(tokens):
+                chunk = {"id": cid, "object": "chat.completion.chunk", "created": created, "model": model, "choices": [{"index": 0, "delta": {"content": tok}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            done = {"id": cid, "object": "chat.completion.chunk", "created": created, "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(done)}\n\ndata: [DONE]\n\n"
+        return StreamingResponse(events(), media_type="text/event-stream")
+    text = "".join([tok async for tok in _paced(tokens)])
+    return {"id": cid, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": _prompt_tokens(body), "completion_tokens": len(tokens), "total_tokens": _prompt_tokens(body) + len(tokens)}}
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Fake Ollama (/api/generate, /api/chat) and OpenAI (/v1/chat/completions) server for benchmarks. "
+                                             "Point the backend at it with OLLAMA_URL=http://HOST:PORT and/or OPENAI_BASE_URL=http://HOST:PORT/v1 OPENAI_API_KEY=stub.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=11434)
+    ap.add_argument("--latency-ms", type=float, default=cfg.latency_ms, help="delay before the first token")
+    ap.add_argument("--tokens-per-sec", type=float, default=cfg.tokens_per_sec, help="generation speed; 0 for instant")
+    ap.add_argument("--reply-tokens", type=int, default=cfg.reply_tokens, help="tokens per reply (capped by the request's max tokens)")
+    ap.add_argument("--failure-rate", type=float, default=cfg.failure_rate, help="fraction of requests answered with HTTP 503")
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+    cfg.latency_ms, cfg.tokens_per_sec, cfg.reply_tokens, cfg.failure_rate = args.latency_ms, args.tokens_per_sec, args.reply_tokens, args.failure_rate
+    rng.seed(args.seed)
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import re
+import uuid
+import asyncio
+import hashlib
+import logging
+from typing import Dict, Any, Optional, AsyncIterator, Iterator, List, Tuple
+
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from metrics import record_storage
+from storage import BASE_DIR
+
+logger = logging.getLogger(__name__)
+
+BLOB_DIR = os.getenv("WALLPAPER_DIR", os.path.join(BASE_DIR, "blobs"))
+WALLPAPER_MAX_BYTES = int(os.getenv("WALLPAPER_MAX_BYTES", str(10 * 1024 * 1024)))
+# room for the multipart boundaries, part headers and any small extra fields around the file
+MULTIPART_OVERHEAD = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# content types are sniffed from the bytes, never taken from the client, so a blob always serves the same way
+_SIGNATURES = ((b"\x89PNG\r\n\x1a\n", "image/png"), (b"\xff\xd8\xff", "image/jpeg"), (b"GIF87a", "image/gif"), (b"GIF89a", "image/gif"))
+
+class BlobTooLarge(ValueError):
+    pass
+
+class MalformedUpload(ValueError):
+    pass
+
+def is_blob_id(sha: str) -> bool:
+    return bool(_SHA256_RE.match(sha or ""))
+
+def blob_path(sha: str) -> str:
+    return os.path.join(BLOB_DIR, sha[:2], sha)
+
+def sniff_content_type(head: bytes) -> str:
+    for magic, ctype in _SIGNATURES:
+        if head.startswith(magic):
+            return ctype
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def _write(f, chunk: bytes) -> None:
+    f.write(chunk)
+
+async def store(chunks: AsyncIterator[bytes], max_bytes: int = WALLPAPER_MAX_BYTES) -> Dict[str, Any]:
+    # hashes while streaming to a temp file, then renames it into place; identical uploads from any chat share one blob
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    tmp = os.path.join(BLOB_DIR, f".upload-{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    try:
+        f = await asyncio.to_thread(open, tmp, "wb")
+        try:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > max_bytes:
+                    raise BlobTooLarge(f"Wallpaper exceeds the {max_bytes} byte limit")
+                if len(head) < 16:
+                    head += chunk[:16]
+                digest.update(chunk)
+                await asyncio.to_thread(_write, f, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+        sha = digest.hexdigest()
+        dest = blob_path(sha)
+        if os.path.exists(dest):
+            os.remove(tmp)
+            logger.info("Wallpaper %s already stored; deduplicated %d bytes", sha, size)
+        else:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(tmp, dest)
+            record_storage("write", size)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return {"sha256": sha, "size": size, "content_type": sniff_content_type(head), "url": f"/wallpapers/{sha}"}
+
+async def multipart_file(body: AsyncIterator[bytes], content_type: str, found: Dict[str, Any], field: str = "file", max_bytes: int = WALLPAPER_MAX_BYTES + MULTIPART_OVERHEAD) -> AsyncIterator[bytes]:
+    # yields the contents of one file field of a multipart/form-data body as it arrives, so nothing is spooled before
+    # store() sees it; found gets the part's filename. The whole body is capped too, so other parts cannot be used to
+    # make the server read without limit
+    _, params = parse_options_header(content_type)
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise MalformedUpload("Missing multipart boundary")
+    part: Dict[str, Any] = {}
+    header = [b"", b""]
+    out: List[bytes] = []
+    def on_part_begin() -> None:
+        part.clear()
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header[0] += data[start:end]
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header[1] += data[start:end]
+    def on_header_end() -> None:
+        if header[0].lower() == b"content-disposition":
+            _, options = parse_options_header(header[1])
+            # a part without a filename is a plain form field, not a file
+            if options.get(b"name") == field.encode() and b"filename" in options and "filename" not in found:
+                found["filename"] = options[b"filename"].decode("utf-8", "replace")
+                part["file"] = True
+        header[0] = header[1] = b""
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        if part.get("file"):
+            out.append(data[start:end])
+    parser = MultipartParser(boundary, {"on_part_begin": on_part_begin, "on_header_field": on_header_field, "on_header_value": on_header_value, "on_header_end": on_header_end, "on_part_data": on_part_data})
+    total = 0
+    try:
+        async for chunk in body:
+            total += len(chunk)
+            if total > max_bytes:
+                raise BlobTooLarge(f"Wallpaper exceeds the {WALLPAPER_MAX_BYTES} byte limit")
+            parser.write(chunk)
+            if out:
+                yield b"".join(out)
+                out.clear()
+        parser.finalize()
+    except MultipartParseError as e:
+        raise MalformedUpload(f"Malformed multipart body: {e}") from e
+    if "filename" not in found:
+        raise MalformedUpload("Missing file field")
+
+def open_blob(sha: str) -> Optional[Tuple[str, int, str]]:
+    # (path, size, content type), or None when the blob does not exist
+    if not is_blob_id(sha):
+        return None
+    p = blob_path(sha)
+    try:
+        size = os.path.getsize(p)
+        with open(p, "rb") as f:
+            head = f.read(16)
+    except OSError:
+        return None
+    return p, size, sniff_content_type(head)
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    # single byte range only; returns inclusive (start, end), None to serve the whole file, raises ValueError if unsatisfiable
+    m = _RANGE_RE.match((header or "").strip())
+    if not m:
+        return None
+    first, last = m.group(1), m.group(2)
+    if not first and not last:
+        return None
+    if not first:
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+def iter_file(path: str, start: int, end: int) -> Iterator[bytes]:
+    # sync generator; Starlette runs it in its threadpool
+    remaining = end - start + 1
+    with open(path, "rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+    record_storage("read", end - start + 1)
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Any, Callable, Generic, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+CONFIG_DIR = os.getenv("CONFIG_DIR", os.path.dirname(os.path.abspath(__file__)))
+CONFIG_CHECK_INTERVAL = float(os.getenv("CONFIG_CHECK_INTERVAL", "2"))
+
+T = TypeVar("T")
+
+class WatchedConfig(Generic[T]):
+    # a JSON file re-read when its mtime/size changes; readers always get one complete value (the reference is swapped,
+    # never mutated), a broken edit keeps the last good value, and a missing file falls back to the built-in default
+    def __init__(self, filename: str, default: T, validate: Optional[Callable[[Any], T]] = None, interval: float = CONFIG_CHECK_INTERVAL) -> None:
+        self.path = os.path.join(CONFIG_DIR, filename)
+        self.default = default
+        self.validate = validate or (lambda data: data)
+        self.interval = interval
+        self.version = 0
+        self._value = default
+        self._stamp: Optional[tuple] = None
+        self._checked = float("-inf")
+        self._lock = threading.Lock()
+        self.get()
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def get(self) -> T:
+        now = time.monotonic()
+        if now - self._checked < self.interval:
+            return self._value
+        with self._lock:
+            if now - self._checked < self.interval:
+                return self._value
+            self._checked = now
+            stamp = self._stat()
+            if stamp == self._stamp:
+                return self._value
+            self._stamp = stamp
+            if stamp is None:
+                value = self.default
+                logger.info("Config %s not found; using built-in defaults", self.path)
+            else:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        value = self.validate(json.load(f))
+                except Exception as e:
+                    logger.warning("Failed to load %s, keeping the previous value: %s", self.path, e)
+                    return self._value
+                if self.version:
+                    logger.info("Reloaded %s", self.path)
+            self._value = value
+            self.version += 1
+            return value
+
+def str_map(data: Any) -> dict:
+    if not isinstance(data, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in data.items()):
+        raise ValueError("expected an object of string values")
+    return data
+
+def str_list(data: Any) -> list:
+    if not isinstance(data, list) or not all(isinstance(v, str) for v in data):
+        raise ValueError("expected a list of strings")
+    return data
@@ -0,0 +1,81 @@
+import os
+import logging
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "250"))
+# after a fold the window shrinks to this fraction of the budget, so the summary is only
+# recomputed every few turns instead of on every message that crosses the limit
+CONTEXT_LOW_WATER = float(os.getenv("CONTEXT_LOW_WATER", "0.6"))
+
+MODEL_TOKEN_BUDGETS = {"Vanilla Short": 1500, "Blueberry": 6000, "Unicorn": 6000, "Blackberry": 4000, "Sage": 12000}
+MODEL_SUMMARY_BUDGETS = {"Sage": 800, "Blueberry": 400, "Unicorn": 400, "Blackberry": 400}
+
+SUMMARY_PROMPT = ("You maintain the long-term memory of an ongoing roleplay chat. Merge the previous summary and the new lines into one "
+                  "updated summary written in the third person. Keep names, relationships, promises, secrets, emotional shifts and unresolved "
+                  "plot threads; drop small talk. Reply with the summary only.")
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prose; close enough for budgeting without a tokenizer dependency
+    return len(text or "") // 4 + 1
+
+def message_tokens(m: Dict[str, Any]) -> int:
+    return estimate_tokens(m.get("content", "")) + 4
+
+def token_budget(model_name: str) -> int:
+    return MODEL_TOKEN_BUDGETS.get(model_name, CONTEXT_TOKEN_BUDGET)
+
+def summary_budget(model_name: str) -> int:
+    return MODEL_SUMMARY_BUDGETS.get(model_name, SUMMARY_TOKEN_BUDGET)
+
+def plan_context(messages: List[Dict[str, Any]], memory: Optional[Dict[str, Any]], budget: int, low_water: float = CONTEXT_LOW_WATER) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    # returns (window, to_fold): the raw messages to send, and the older ones that must be folded into the summary first
+    upto = (memory or {}).get("upto")
+    start = 0
+    if upto:
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i].get("id") == upto:
+                start = i + 1
+                break
+    pending = messages[start:]
+    costs = [message_tokens(m) for m in pending]
+    total = sum(costs)
+    if total <= budget:
+        return pending, []
+    target = int(budget * low_water)
+    cut = 0
+    while cut < len(pending) - 1 and total > target:
+        total -= costs[cut]
+        cut += 1
+    return pending[cut:], pending[:cut]
+
+def clip_to_tokens(text: str, max_tokens: int) -> str:
+    limit = max_tokens * 4
+    return text if len(text) <= limit else "..." + text[-limit:]
+
+def extractive_summary(previous: str, folded: List[Dict[str, Any]], max_tokens: int) -> str:
+    lines = [previous] if previous else []
+    for m in folded:
+        content = " ".join((m.get("content") or "").split())
+        lines.append(f"{m.get('role', 'user')}: {content[:200]}")
+    return clip_to_tokens("\n".join(lines), max_tokens)
+
+def summary_request(previous: str, folded: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    transcript = "\n".join(f"{m.get('role', 'user').upper()}: {m.get('content', '')}" for m in folded)
+    return [{"role": "user", "content": f"Previous summary:\n{previous or '(none)'}\n\nNew lines:\n{transcript}"}]
+
+async def fold_summary(previous: str, folded: List[Dict[str, Any]], max_tokens: int, summarize: Callable[[List[Dict[str, str]], int], Awaitable[str]]) -> str:
+    try:
+        summary = (await summarize(summary_request(previous, folded), max_tokens)).strip()
+    except Exception as e:
+        logger.warning("Summarization failed, falling back to an extractive summary: %s", e)
+        summary = ""
+    return clip_to_tokens(summary, max_tokens) if summary else extractive_summary(previous, folded, max_tokens)
+
+def memory_message(memory: Optional[Dict[str, Any]]) -> Optional[Dict[str, str]]:
+    summary = (memory or {}).get("summary")
+    if not summary:
+        return None
+    return {"role": "system", "content": f"STORY SO FAR (earlier conversation, summarized):\n{summary}"}
@@ -1,6 +1,7 @@
 import re  
 import random  
-from typing import Dict, Any, List, Optional  
+from typing import Dict, Any, List, Optional, Iterable, Tuple, Pattern  
+from tag_personalities import TagFlags, tag_flags  
   
 DEFAULT_INTENSITY_DECAY = 0.85  
 MIN_INTENSITY = 0  
@@ -28,13 +29,81 @@ REACTION_SNIPPETS = {
 def clamp(x: float, a: float = MIN_INTENSITY, b: float = MAX_INTENSITY) -> int:  
     return int(max(a, min(b, x)))  
   
-def score_triggers(text: str) -> Dict[str, int]:  
-    t = (text or "").lower()  
-    scores = {k: 0 for k in TRIGGERS}  
-    for k, words in TRIGGERS.items():  
+class _WordChars(dict):  
+    # str.translate table that lowercases word characters and turns everything else into a space, so phrases only  
+    # match whole words; code points are classified the first time they are seen  
+    def __missing__(self, c: int) -> str:  
+        ch = chr(c)  
+        self[c] = ch.lower() if ch.isalnum() or ch == "_" else " "  
+        return self[c]  
+  
+_WORD_CHARS = _WordChars()  
+  
+def _words(text: Optional[str]) -> str:  
+    return f" {(text or '').translate(_WORD_CHARS)} "  
+  
+def _trie_pattern(words: Iterable[str]) -> str:  
+    # factor the phrases into a prefix trie so the regex branches on one character at a time  
+    # instead of trying every alternative at every word start  
+    trie: Dict[str, Any] = {}  
+    for w in words:  
+        node = trie  
+        for ch in w:  
+            node = node.setdefault(ch, {})  
+        node[""] = {}  
+    def build(node: Dict[str, Any]) -> str:  
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]  
+        if not branches:  
+            return ""  
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"  
+        return "(?:" + body + ")?" if "" in node else body  
+    return build(trie)  
+  
+def compile_triggers(triggers: Dict[str, List[str]]) -> Tuple[Dict[str, List[Tuple[str, int]]], Pattern, Dict[str, List[str]]]:  
+    # phrases are keyed as they appear in _words() output, with the leading space the scan consumes (" don t")  
+    phrases: Dict[str, List[Tuple[str, int]]] = {}  
+    for k, words in triggers.items():  
         for w in words:  
-            if w in t:  
-                scores[k] += max(1, len(w) // 3)  
+            phrases.setdefault(_words(w)[:-1], []).append((k, max(1, len(w) // 3)))  
+    # each match consumes its phrase, which is cheaper than a lookahead at every word start but hides phrases that  
+    # start inside it ("with who is that"); those are checked directly when the covering phrase is found  
+    overlaps: Dict[str, List[str]] = {}  
+    for p in phrases:  
+        head = p.split()  
+        for q in phrases:  
+            tail = q.split()  
+            if any(tail[:len(head) - i] == head[i:i + len(tail)] for i in range(1, len(head))):  
+                overlaps.setdefault(p, []).append(q)  
+    # "\x00" separates messages in a batch scan and is matched too, so the results split back per message  
+    return phrases, re.compile(r" (?:" + _trie_pattern(p[1:] for p in phrases) + r"|\x00)(?= )"), overlaps  
+  
+_PHRASES, _TRIGGER_RE, _OVERLAPS = compile_triggers(TRIGGERS)  
+_NEGATION_RE = re.compile(r"\b(no|don't|can't|not|never)\b")  
+_WITHDRAW_RE = re.compile(r"\b(leave|alone|stop)\b")  
+  
+def _score_phrases(matches: Iterable[str], words: str) -> Dict[str, int]:  
+    found = set(matches)  
+    hidden = {q for p in found & _OVERLAPS.keys() for q in _OVERLAPS[p]} - found  
+    found.update(q for q in hidden if q + " " in words)  
+    scores = dict.fromkeys(TRIGGERS, 0)  
+    for w in found:  
+        for k, weight in _PHRASES[w]:  
+            scores[k] += weight  
+    return scores  
+  
+def score_triggers(text: str) -> Dict[str, int]:  
+    words = _words(text)  
+    return _score_phrases(_TRIGGER_RE.findall(words), words)  
+  
+def score_triggers_batch(texts: Iterable[str]) -> List[Dict[str, int]]:  
+    # one scan over all messages joined by "\x00"; the separator matches split the results back per message  
+    words = [_words(t) for t in texts]  
+    matches = _TRIGGER_RE.findall("\x00".join(words) + "\x00 ")  
+    scores, start = [], 0  
+    for w in words:  
+        end = matches.index(" \x00", start)  
+        scores.append(_score_phrases(matches[start:end], w))  
+        start = end + 1  
     return scores  
   
 def dominant_from_scores(scores: Dict[str, int]) -> Optional[str]:  
@@ -43,28 +112,27 @@ def dominant_from_scores(scores: Dict[str, int]) -> Optional[str]:
     k = max(scores.keys(), key=lambda x: scores[x])  
     return k if scores[k] > 0 else None  
   
-def build_emotion_hint(prev_hint: Optional[Dict[str, Any]], user_text: str, bot_text: str, tags: List[str] = None, emotion_state: Dict[str, Any] = None) -> Dict[str, Any]:  
-    tags = tags or []  
+def build_emotion_hint(prev_hint: Optional[Dict[str, Any]], user_text: str, bot_text: str, tags: List[str] = None, emotion_state: Dict[str, Any] = None, flags: Optional[TagFlags] = None) -> Dict[str, Any]:  
+    flags = flags or tag_flags(tags)  
     emotion_state = emotion_state or {}  
-    user_scores = score_triggers(user_text or "")  
-    bot_scores = score_triggers(bot_text or "")  
+    user_scores, bot_scores = score_triggers_batch([user_text, bot_text])  
     combined = {k: user_scores.get(k, 0) + bot_scores.get(k, 0) for k in TRIGGERS.keys()}  
     base = sum(combined.values()) * 6  
     prev_int = (prev_hint.get("intensity", 0) if prev_hint else 0)  
     intensity = clamp(base + prev_int * DEFAULT_INTENSITY_DECAY)  
-    if "Taboo" in tags or "Dark Romance" in tags:  
+    if flags.taboo_or_dark:  
         intensity = clamp(intensity + 8)  
-    if "Flirty" in tags or "Seductive" in tags:  
+    if flags.flirty_or_seductive:  
         intensity = clamp(intensity + 6)  
-    if "Cold" in tags:  
+    if flags.cold:  
         intensity = clamp(intensity - 6)  
     dom = dominant_from_scores(combined)  
     mapping = {"affection": "soft", "flirty": "aroused", "tease": "conflicted", "anger": "angry", "fear": "nervous", "curiosity": "curious", "jealousy": "jealous", "sad": "sad"}  
     primary = mapping.get(dom, None)  
-    if "Yandere" in tags:  
+    if flags.yandere:  
         primary = "jealous" if not primary else primary  
         intensity = clamp(intensity + 10)  
-    if "Tsundere" in tags and primary is None:  
+    if flags.tsundere and primary is None:  
         primary = "conflicted"  
     meta = {  
         "attraction": clamp((combined.get("flirty", 0) + combined.get("affection", 0)) * 8 + emotion_state.get("attraction", 0) // 2),  
@@ -75,8 +143,9 @@ def build_emotion_hint(prev_hint: Optional[Dict[str, Any]], user_text: str, bot_
     snippet = random.choice(snippet_pool) if snippet_pool else ""  
     contradict = False  
     if bot_text:  
-        if re.search(r"\b(no|don't|can't|not|never)\b", bot_text.lower()) and meta["attraction"] > 20:  
+        bot_lower = bot_text.lower()  
+        if meta["attraction"] > 20 and _NEGATION_RE.search(bot_lower):  
             contradict = True  
-        if re.search(r"\b(leave|alone|stop)\b", bot_text.lower()) and meta["trust"] > 40:  
+        if meta["trust"] > 40 and _WITHDRAW_RE.search(bot_lower):  
             contradict = True  
     return {"primary": primary or "neutral", "secondary": [], "intensity": intensity, "meta": meta, "snippet": snippet, "contradiction": contradict}
\ No newline at end of file
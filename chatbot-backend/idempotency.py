@@ -0,0 +1,71 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple, Callable, Awaitable
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+
+Key = Tuple[str, str]
+
+# replies generated while the provider was failing; a retry should try the provider again, not replay these
+UNCACHED_OUTCOMES = ("fallback", "error")
+
+class IdempotencyConflict(ValueError):
+    pass
+
+def fingerprint(*parts: Optional[str]) -> str:
+    return hashlib.sha256("\x00".join(p or "" for p in parts).encode("utf-8")).hexdigest()
+
+class RequestCoalescer:
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_entries: int = IDEMPOTENCY_MAX_ENTRIES) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._inflight: Dict[Key, Tuple[str, asyncio.Future]] = {}
+        self._results: "OrderedDict[Key, Tuple[float, str, Any]]" = OrderedDict()
+
+    def _purge(self, now: float) -> None:
+        # entries are inserted in completion order with a fixed TTL, so expired ones sit at the front
+        while self._results:
+            key, (expires, _, _) = next(iter(self._results.items()))
+            if expires > now and len(self._results) <= self.max_entries:
+                break
+            self._results.popitem(last=False)
+
+    async def run(self, key: Key, fp: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        self._purge(time.monotonic())
+        cached = self._results.get(key)
+        if cached is not None:
+            if cached[1] != fp:
+                raise IdempotencyConflict("Idempotency key was already used for a different request")
+            logger.info("Serving chat %s key %s from the idempotency cache", *key)
+            return cached[2]
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            if inflight[0] != fp:
+                raise IdempotencyConflict("Idempotency key is in use by a different request")
+            logger.info("Attaching chat %s key %s to the in-flight generation", *key)
+            return await asyncio.shield(inflight[1])
+        task = asyncio.ensure_future(factory())
+        self._inflight[key] = (fp, task)
+        task.add_done_callback(lambda t: self._finish(key, fp, t))
+        # shield: a client that disconnects must not cancel the generation its retries are waiting on
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Key, fp: str, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            # failures are not cached, so a retry gets a fresh attempt
+            return
+        result = task.result()
+        if isinstance(result, dict) and result.get("outcome") in UNCACHED_OUTCOMES:
+            return
+        self._results[key] = (time.monotonic() + self.ttl, fp, result)
+        self._purge(time.monotonic())
+
+coalescer = RequestCoalescer()
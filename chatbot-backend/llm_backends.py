@@ -1,116 +1,371 @@
 import os  
 import json  
-import pathlib  
-import requests  
+import hashlib  
+import asyncio  
+import importlib  
 import logging  
-from typing import List, Dict, Any, Optional  
+from contextlib import aclosing  
+from typing import List, Dict, Any, Optional, Callable, Awaitable, AsyncIterator, Tuple  
   
-logger = logging.getLogger(__name__)  
+import httpx  
   
-try:  
-    import openai  
-except Exception:  
-    openai = None  
+import metrics  
+from config_watch import WatchedConfig, str_map  
+from provider_router import router  
   
-try:  
-    from emergentintegrations.llm.chat import LlmChat  
-except Exception:  
-    LlmChat = None  
+logger = logging.getLogger(__name__)  
   
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")  
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")  
 ANTHROPIC_KEY = os.getenv("ANTHROPIC_API_KEY")  
 GOOGLE_KEY = os.getenv("GOOGLE_API_KEY")  
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")  
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  
+OLLAMA_CONTEXT_REUSE = os.getenv("OLLAMA_CONTEXT_REUSE", "false").lower() in ("1", "true", "yes")  
 USE_EMERGENT = os.getenv("USE_EMERGENT", "false").lower() in ("1", "true", "yes")  
 EMERGENT_DEFAULT_MODEL = os.getenv("EMERGENT_MODEL", "default")  
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))  
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "200"))  
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "50"))  
   
 DEFAULT_MODEL_PROVIDER_MAP = {"Vanilla": "ollama", "Vanilla Short": "ollama", "Matcha": "ollama", "Strawberry": "openai", "Chocolate": "openai", "Peach": "ollama", "Blueberry": "openai", "Mint": "openai", "Blackberry": "openai", "Rainbow": "openai", "Unicorn": "openai", "Sage": "openai"}  
   
-def load_model_provider_map() -> Dict[str, str]:  
-    cfg_path = pathlib.Path(__file__).parent / "model_provider_map.json"  
-    if cfg_path.exists():  
+PROVIDER_NAMES = ("openai", "ollama", "emergent", "claude", "gemini")  
+  
+class UnknownProvider(ValueError):  
+    pass  
+  
+def _provider_map_config(data: Any) -> Dict[str, str]:  
+    data = str_map(data)  
+    unknown = sorted({v for v in data.values() if v.lower() not in PROVIDER_NAMES})  
+    if unknown:  
+        raise ValueError(f"unknown providers {unknown}")  
+    return data  
+  
+# reloaded when model_provider_map.json changes, so routing can move between providers without a restart  
+_provider_map = WatchedConfig("model_provider_map.json", DEFAULT_MODEL_PROVIDER_MAP, _provider_map_config)  
+  
+def get_model_provider_map() -> Dict[str, str]:  
+    return _provider_map.get()  
+  
+# provider SDKs are imported on first use; a worker that only talks to Ollama never pays for them at startup  
+_sdk_modules: Dict[str, Any] = {}  
+  
+def _load_sdk(name: str, load: Callable[[], Any]) -> Any:  
+    if name not in _sdk_modules:  
         try:  
-            with cfg_path.open("r", encoding="utf-8") as f:  
-                return json.load(f)  
+            _sdk_modules[name] = load()  
         except Exception as e:  
-            logger.warning("Failed to load model_provider_map.json: %s", e)  
-    return DEFAULT_MODEL_PROVIDER_MAP  
+            logger.info("%s SDK not available: %s", name, e)  
+            _sdk_modules[name] = None  
+    return _sdk_modules[name]  
   
-MODEL_PROVIDER_MAP = load_model_provider_map()  
+def _openai_sdk() -> Any:  
+    return _load_sdk("openai", lambda: importlib.import_module("openai"))  
   
-def call_openai(messages: List[Dict[str, str]], model: str = "gpt-4o", max_tokens: int = 512, temperature: float = 0.8) -> str:  
-    if openai is None:  
-        raise RuntimeError("OpenAI SDK not installed. Run: pip install openai")  
-    if OPENAI_KEY is None:  
+def _emergent_chat_cls() -> Any:  
+    return _load_sdk("emergent", lambda: importlib.import_module("emergentintegrations.llm.chat").LlmChat)  
+  
+def _openai_ready() -> bool:  
+    # checks the key first so the SDK is only imported when it could actually be used  
+    return bool(OPENAI_KEY) and _openai_sdk() is not None  
+  
+_http_client: Optional[httpx.AsyncClient] = None  
+_openai_client: Any = None  
+_client_loop: Optional[asyncio.AbstractEventLoop] = None  
+  
+def get_http_client() -> httpx.AsyncClient:  
+    # one pooled keep-alive client per event loop, shared by every request and the OpenAI SDK  
+    global _http_client, _openai_client, _client_loop  
+    loop = asyncio.get_running_loop()  
+    if _http_client is None or _http_client.is_closed or _client_loop is not loop:  
+        _http_client = httpx.AsyncClient(timeout=LLM_TIMEOUT, limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_KEEPALIVE))  
+        _openai_client = None  
+        _client_loop = loop  
+    return _http_client  
+  
+def get_openai_client() -> Any:  
+    global _openai_client  
+    http_client = get_http_client()  
+    if _openai_client is None:  
+        _openai_client = _openai_sdk().AsyncOpenAI(api_key=OPENAI_KEY, base_url=OPENAI_BASE_URL, http_client=http_client)  
+    return _openai_client  
+  
+async def aclose() -> None:  
+    global _http_client, _openai_client, _client_loop  
+    if _http_client is not None and not _http_client.is_closed:  
+        await _http_client.aclose()  
+    _http_client, _openai_client, _client_loop = None, None, None  
+  
+async def call_openai(messages: List[Dict[str, str]], model: str = "gpt-4o", max_tokens: int = 512, temperature: float = 0.8) -> str:  
+    if not OPENAI_KEY:  
         raise RuntimeError("OPENAI_API_KEY not configured in environment.")  
-    client = openai.OpenAI(api_key=OPENAI_KEY, base_url=OPENAI_BASE_URL)  
+    if _openai_sdk() is None:  
+        raise RuntimeError("OpenAI SDK not installed. Run: pip install openai")  
+    client = get_openai_client()  
     try:  
-        response = client.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature)  
+        with metrics.provider_span("openai", model):  
+            response = await client.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature)  
+        usage = getattr(response, "usage", None)  
+        if usage is not None:  
+            metrics.record_tokens("openai", model, usage.prompt_tokens, usage.completion_tokens)  
         return response.choices[0].message.content  
     except Exception as e:  
         logger.error(f"OpenAI API error: {e}")  
         raise RuntimeError(f"OpenAI API error: {e}")  
   
-def call_ollama(model: str, prompt: str, max_tokens: int = 512, temperature: float = 0.8) -> str:  
-    url = f"{OLLAMA_URL}/api/generate"  
-    payload = {"model": model, "prompt": prompt, "options": {"num_predict": max_tokens, "temperature": temperature}, "stream": False}  
-    try:  
-        resp = requests.post(url, json=payload, timeout=60)  
+def _ollama_payload(model: str, max_tokens: int, temperature: float, stream: bool, **fields: Any) -> Dict[str, Any]:  
+    return {"model": model, "options": {"num_predict": max_tokens, "temperature": temperature}, "stream": stream, "keep_alive": OLLAMA_KEEP_ALIVE, **{k: v for k, v in fields.items() if v is not None}}  
+  
+async def _ollama_post(path: str, model: str, payload: Dict[str, Any]) -> Any:  
+    with metrics.provider_span("ollama", model):  
+        resp = await get_http_client().post(f"{OLLAMA_URL}{path}", json=payload)  
         resp.raise_for_status()  
-        data = resp.json()  
-        if isinstance(data, dict) and "response" in data:  
-            return data["response"]  
-        if isinstance(data, dict) and "text" in data:  
-            return data["text"]  
-        if isinstance(data, list) and len(data) > 0:  
-            return data[0].get("content", "")  
-        return json.dumps(data)  
+    data = resp.json()  
+    if isinstance(data, dict):  
+        metrics.record_tokens("ollama", model, data.get("prompt_eval_count"), data.get("eval_count"))  
+    return data  
+  
+def _ollama_text(data: Any) -> str:  
+    if isinstance(data, dict) and isinstance(data.get("message"), dict):  
+        return data["message"].get("content", "")  
+    if isinstance(data, dict) and "response" in data:  
+        return data["response"]  
+    if isinstance(data, dict) and "text" in data:  
+        return data["text"]  
+    if isinstance(data, list) and len(data) > 0:  
+        return data[0].get("content", "")  
+    return json.dumps(data)  
+  
+async def call_ollama(model: str, prompt: str, max_tokens: int = 512, temperature: float = 0.8, system: Optional[str] = None, context: Optional[List[int]] = None, session: Optional[Dict[str, Any]] = None) -> str:  
+    try:  
+        data = await _ollama_post("/api/generate", model, _ollama_payload(model, max_tokens, temperature, False, prompt=prompt, system=system, context=context))  
+        if session is not None and isinstance(data, dict) and data.get("context"):  
+            session["context"] = data["context"]  
+        return _ollama_text(data)  
     except Exception as e:  
         logger.error(f"Ollama API error: {e}")  
         raise RuntimeError(f"Ollama API error: {e}")  
   
-def call_emergent(conversation: List[Dict[str, str]], model_hint: Optional[str] = None, max_tokens: int = 512) -> str:  
-    if LlmChat is None:  
-        raise RuntimeError("Emergent LlmChat wrapper is not available.")  
-    llm = LlmChat(model=model_hint or EMERGENT_DEFAULT_MODEL)  
+async def call_ollama_chat(model: str, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.8) -> str:  
+    try:  
+        data = await _ollama_post("/api/chat", model, _ollama_payload(model, max_tokens, temperature, False, messages=_ollama_messages(messages)))  
+        return _ollama_text(data)  
+    except Exception as e:  
+        logger.error(f"Ollama API error: {e}")  
+        raise RuntimeError(f"Ollama API error: {e}")  
+  
+async def stream_openai(messages: List[Dict[str, str]], model: str = "gpt-4o", max_tokens: int = 512, temperature: float = 0.8) -> AsyncIterator[str]:  
+    if not OPENAI_KEY:  
+        raise RuntimeError("OPENAI_API_KEY not configured in environment.")  
+    if _openai_sdk() is None:  
+        raise RuntimeError("OpenAI SDK not installed. Run: pip install openai")  
+    client = get_openai_client()  
+    try:  
+        with metrics.provider_span("openai", model):  
+            stream = await client.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True)  
+            async for chunk in stream:  
+                if chunk.choices and chunk.choices[0].delta.content:  
+                    yield chunk.choices[0].delta.content  
+    except Exception as e:  
+        logger.error(f"OpenAI API error: {e}")  
+        raise RuntimeError(f"OpenAI API error: {e}")  
+  
+async def _stream_ollama(path: str, model: str, payload: Dict[str, Any], session: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:  
+    try:  
+        with metrics.provider_span("ollama", model):  
+            async with get_http_client().stream("POST", f"{OLLAMA_URL}{path}", json=payload) as resp:  
+                resp.raise_for_status()  
+                async for line in resp.aiter_lines():  
+                    if not line.strip():  
+                        continue  
+                    data = json.loads(line)  
+                    delta = (data.get("message") or {}).get("content") or data.get("response")  
+                    if delta:  
+                        yield delta  
+                    if data.get("done"):  
+                        metrics.record_tokens("ollama", model, data.get("prompt_eval_count"), data.get("eval_count"))  
+                        if session is not None and data.get("context"):  
+                            session["context"] = data["context"]  
+                        break  
+    except Exception as e:  
+        logger.error(f"Ollama API error: {e}")  
+        raise RuntimeError(f"Ollama API error: {e}")  
+  
+def stream_ollama(model: str, prompt: str, max_tokens: int = 512, temperature: float = 0.8, system: Optional[str] = None, context: Optional[List[int]] = None, session: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:  
+    return _stream_ollama("/api/generate", model, _ollama_payload(model, max_tokens, temperature, True, prompt=prompt, system=system, context=context), session)  
+  
+def stream_ollama_chat(model: str, messages: List[Dict[str, str]], max_tokens: int = 512, temperature: float = 0.8) -> AsyncIterator[str]:  
+    return _stream_ollama("/api/chat", model, _ollama_payload(model, max_tokens, temperature, True, messages=_ollama_messages(messages)))  
+  
+def _call_emergent_sync(conversation: List[Dict[str, str]], model_hint: Optional[str], max_tokens: int) -> str:  
+    llm = _emergent_chat_cls()(model=model_hint or EMERGENT_DEFAULT_MODEL)  
     try:  
         return llm.generate(conversation, max_tokens=max_tokens)  
     except Exception:  
         return llm.chat(conversation)  
   
-def call_claude(messages: List[Dict[str, str]], model_hint: Optional[str] = None, max_tokens: int = 512) -> str:  
+async def call_emergent(conversation: List[Dict[str, str]], model_hint: Optional[str] = None, max_tokens: int = 512) -> str:  
+    if _emergent_chat_cls() is None:  
+        raise RuntimeError("Emergent LlmChat wrapper is not available.")  
+    # the wrapper only has a blocking API; keep it off the event loop  
+    with metrics.provider_span("emergent", model_hint or EMERGENT_DEFAULT_MODEL):  
+        return await asyncio.to_thread(_call_emergent_sync, conversation, model_hint, max_tokens)  
+  
+async def call_claude(messages: List[Dict[str, str]], model_hint: Optional[str] = None, max_tokens: int = 512) -> str:  
     if ANTHROPIC_KEY:  
         logger.warning("Claude integration not fully implemented, using OpenAI fallback")  
-    if OPENAI_KEY and openai is not None:  
-        return call_openai(messages, model=model_hint or "gpt-4o", max_tokens=max_tokens)  
+    if _openai_ready():  
+        # call_openai records the span; a second one here would count every call twice  
+        return await call_openai(messages, model=model_hint or "gpt-4o", max_tokens=max_tokens)  
     raise RuntimeError("Claude selected but no Claude integration configured.")  
   
-def call_gemini(messages: List[Dict[str, str]], model_hint: Optional[str] = None, max_tokens: int = 512) -> str:  
+async def call_gemini(messages: List[Dict[str, str]], model_hint: Optional[str] = None, max_tokens: int = 512) -> str:  
     if GOOGLE_KEY:  
         logger.warning("Gemini integration not fully implemented, using OpenAI fallback")  
-    if OPENAI_KEY and openai is not None:  
-        return call_openai(messages, model=model_hint or "gpt-4o", max_tokens=max_tokens)  
+    if _openai_ready():  
+        return await call_openai(messages, model=model_hint or "gpt-4o", max_tokens=max_tokens)  
     raise RuntimeError("Gemini selected but no Gemini integration configured.")  
   
-def choose_and_call(provider: Optional[str], system_prompt: str, messages: List[Dict[str, str]], model_name_hint: Optional[str] = None, model_name: Optional[str] = None, max_tokens: int = 512) -> str:  
-    msgs = [{"role": "system", "content": system_prompt}] + messages  
+def _ollama_prompt(msgs: List[Dict[str, str]]) -> str:  
+    return "\n".join([f"{m['role'].upper()}: {m['content']}" for m in msgs])  
+  
+def _ollama_messages(msgs: List[Dict[str, str]]) -> List[Dict[str, str]]:  
+    return [{"role": m["role"], "content": m["content"]} for m in msgs]  
+  
+def _prefix_hash(model: str, msgs: List[Dict[str, str]]) -> str:  
+    h = hashlib.sha256(model.encode("utf-8"))  
+    for m in msgs:  
+        h.update(b"\x00" + m["role"].encode("utf-8") + b"\x01" + m["content"].encode("utf-8"))  
+    return h.hexdigest()  
+  
+def _plan_ollama_context(model: str, msgs: List[Dict[str, str]], session: Dict[str, Any]) -> Tuple[Optional[str], Optional[List[int]], List[Dict[str, str]], List[Dict[str, str]]]:  
+    # returns (system, context, messages to send as the prompt, durable transcript the new context will cover)  
+    # trailing system messages (the per-turn emotion hint) are sent but kept out of the reusable prefix; the  
+    # stored context still holds the hints it was generated with, which only ever trail a finished turn  
+    end = len(msgs)  
+    while end > 1 and msgs[end - 1]["role"] == "system":  
+        end -= 1  
+    system, durable, ephemeral = msgs[0]["content"], msgs[1:end], msgs[end:]  
+    covered = session.get("covered", 0) if session.get("model") == model else 0  
+    # the context already holds the model's own raw reply, so the stored (style-rewritten) copy of it is skipped  
+    if session.get("context") and 0 < covered < len(durable) and durable[covered]["role"] == "assistant" and _prefix_hash(model, msgs[:1] + durable[:covered]) == session.get("hash"):  
+        # the system prompt is part of the stored context already  
+        return None, session["context"], durable[covered + 1:] + ephemeral, durable  
+    return system, None, durable + ephemeral, durable  
+  
+def _update_session(session: Dict[str, Any], model: str, msgs: List[Dict[str, str]], durable: List[Dict[str, str]], reused: bool) -> None:  
+    if session.get("context"):  
+        session.update(model=model, covered=len(durable), hash=_prefix_hash(model, msgs[:1] + durable))  
+    logger.info("Ollama context %s for %s (%d messages covered)", "reused" if reused else "rebuilt", model, len(durable))  
+  
+async def call_ollama_session(model: str, msgs: List[Dict[str, str]], session: Dict[str, Any], max_tokens: int = 512) -> str:  
+    system, context, new, durable = _plan_ollama_context(model, msgs, session)  
+    # a fresh dict: a failed attempt must not leave a half-updated session behind  
+    fresh: Dict[str, Any] = {}  
+    text = await call_ollama(model, prompt=_ollama_prompt(new), max_tokens=max_tokens, system=system, context=context, session=fresh)  
+    session.clear()  
+    session.update(fresh)  
+    _update_session(session, model, msgs, durable, context is not None)  
+    return text  
+  
+async def stream_ollama_session(model: str, msgs: List[Dict[str, str]], session: Dict[str, Any], max_tokens: int = 512) -> AsyncIterator[str]:  
+    system, context, new, durable = _plan_ollama_context(model, msgs, session)  
+    fresh: Dict[str, Any] = {}  
+    async with aclosing(stream_ollama(model, prompt=_ollama_prompt(new), max_tokens=max_tokens, system=system, context=context, session=fresh)) as stream:  
+        async for delta in stream:  
+            yield delta  
+    session.clear()  
+    session.update(fresh)  
+    _update_session(session, model, msgs, durable, context is not None)  
+  
+def _ollama(msgs: List[Dict[str, str]], hint: Optional[str], max_tokens: int, session: Optional[Dict[str, Any]]) -> Awaitable[str]:  
+    if OLLAMA_CONTEXT_REUSE and session is not None:  
+        return call_ollama_session(hint or "llama2", msgs, session, max_tokens=max_tokens)  
+    return call_ollama_chat(hint or "llama2", msgs, max_tokens=max_tokens)  
+  
+def _stream_ollama_provider(msgs: List[Dict[str, str]], hint: Optional[str], max_tokens: int, session: Optional[Dict[str, Any]]) -> AsyncIterator[str]:  
+    if OLLAMA_CONTEXT_REUSE and session is not None:  
+        return stream_ollama_session(hint or "llama2", msgs, session, max_tokens=max_tokens)  
+    return stream_ollama_chat(hint or "llama2", msgs, max_tokens=max_tokens)  
+  
+# session: per-chat provider state the caller persists between turns (currently the Ollama KV context)  
+ProviderFn = Callable[[List[Dict[str, str]], Optional[str], int, Optional[Dict[str, Any]]], Awaitable[str]]  
+  
+PROVIDERS: Dict[str, ProviderFn] = {  
+    "openai": lambda msgs, hint, max_tokens, session: call_openai(msgs, model=hint or "gpt-4o", max_tokens=max_tokens),  
+    "ollama": _ollama,  
+    "emergent": lambda msgs, hint, max_tokens, session: call_emergent(msgs, model_hint=hint, max_tokens=max_tokens),  
+    "claude": lambda msgs, hint, max_tokens, session: call_claude(msgs, model_hint=hint, max_tokens=max_tokens),  
+    "gemini": lambda msgs, hint, max_tokens, session: call_gemini(msgs, model_hint=hint, max_tokens=max_tokens),  
+}  
+  
+StreamFn = Callable[[List[Dict[str, str]], Optional[str], int, Optional[Dict[str, Any]]], AsyncIterator[str]]  
+  
+async def _stream_whole(fn: ProviderFn, msgs: List[Dict[str, str]], hint: Optional[str], max_tokens: int, session: Optional[Dict[str, Any]]) -> AsyncIterator[str]:  
+    # providers without a streaming API deliver the whole completion as a single chunk  
+    yield await fn(msgs, hint, max_tokens, session)  
+  
+STREAM_PROVIDERS: Dict[str, StreamFn] = {  
+    "openai": lambda msgs, hint, max_tokens, session: stream_openai(msgs, model=hint or "gpt-4o", max_tokens=max_tokens),  
+    "ollama": _stream_ollama_provider,  
+}  
+  
+def resolve_provider(provider: Optional[str], model_name: Optional[str] = None) -> str:  
     chosen = (provider or "auto").lower()  
     if chosen in ("auto", ""):  
-        chosen = MODEL_PROVIDER_MAP.get(model_name, None) or ("openai" if OPENAI_KEY else ("ollama" if OLLAMA_URL else ("emergent" if USE_EMERGENT else "ollama")))  
+        chosen = get_model_provider_map().get(model_name, None) or ("openai" if OPENAI_KEY else ("ollama" if OLLAMA_URL else ("emergent" if USE_EMERGENT else "ollama")))  
     chosen = chosen.lower()  
+    if chosen not in PROVIDERS:  
+        raise UnknownProvider(f"Unknown provider: {provider}")  
+    return chosen  
+  
+def backend_provider(provider: str) -> str:  
+    # the backend whose capacity a provider actually uses: claude and gemini are served through the OpenAI client  
+    return "openai" if provider in ("claude", "gemini") else provider  
+  
+def provider_available(provider: str) -> bool:  
+    if provider in ("openai", "claude", "gemini"):  
+        return _openai_ready()  
+    if provider == "emergent":  
+        return USE_EMERGENT and _emergent_chat_cls() is not None  
+    if provider == "ollama":  
+        return bool(OLLAMA_URL)  
+    return provider in PROVIDERS  
+  
+router.available = provider_available  
+# persona names double as model hints, and fallbacks are called with their configured models  
+metrics.add_model_source(get_model_provider_map)  
+metrics.add_model_source(lambda: [*router.fallback_models.values(), EMERGENT_DEFAULT_MODEL])  
+  
+async def _invoke(provider: str, msgs: List[Dict[str, str]], model_name_hint: Optional[str], max_tokens: int, session: Optional[Dict[str, Any]] = None) -> str:  
+    fn = PROVIDERS.get(provider)  
+    if fn is None:  
+        raise UnknownProvider(f"Unknown provider: {provider}")  
+    return await fn(msgs, model_name_hint, max_tokens, session)  
+  
+def _open_stream(provider: str, msgs: List[Dict[str, str]], model_name_hint: Optional[str], max_tokens: int, session: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:  
+    if provider in ("claude", "gemini") and _openai_ready():  
+        # same OpenAI fallback as call_claude/call_gemini, but streamed  
+        provider = "openai"  
+    stream_fn = STREAM_PROVIDERS.get(provider)  
+    if stream_fn is not None:  
+        return stream_fn(msgs, model_name_hint, max_tokens, session)  
+    if provider not in PROVIDERS:  
+        raise UnknownProvider(f"Unknown provider: {provider}")  
+    return _stream_whole(PROVIDERS[provider], msgs, model_name_hint, max_tokens, session)  
+  
+async def choose_and_call(provider: Optional[str], system_prompt: str, messages: List[Dict[str, str]], model_name_hint: Optional[str] = None, model_name: Optional[str] = None, max_tokens: int = 512, session: Optional[Dict[str, Any]] = None) -> str:  
+    msgs = [{"role": "system", "content": system_prompt}] + messages  
+    chosen = resolve_provider(provider, model_name)  
     logger.info("choose_and_call: model_name=%s -> provider=%s (hint=%s)", model_name, chosen, model_name_hint)  
-    if chosen == "openai":  
-        return call_openai(msgs, model=model_name_hint or "gpt-4o", max_tokens=max_tokens)  
-    if chosen == "ollama":  
-        joined = "\n".join([f"{m['role'].upper()}: {m['content']}" for m in msgs])  
-        return call_ollama(model_name_hint or "llama2", prompt=joined, max_tokens=max_tokens)  
-    if chosen == "emergent":  
-        return call_emergent(msgs, model_hint=model_name_hint, max_tokens=max_tokens)  
-    if chosen == "claude":  
-        return call_claude(msgs, model_hint=model_name_hint, max_tokens=max_tokens)  
-    if chosen == "gemini":  
-        return call_gemini(msgs, model_hint=model_name_hint, max_tokens=max_tokens)  
-    if OPENAI_KEY:  
-        return call_openai(msgs, model=model_name_hint or "gpt-4o", max_tokens=max_tokens)  
-    return call_ollama(model_name_hint or "llama2", prompt="\n".join([m["content"] for m in msgs]), max_tokens=max_tokens)
\ No newline at end of file
+    return await router.call(chosen, model_name_hint, lambda name, model: _invoke(name, msgs, model, max_tokens, session))  
+  
+async def choose_and_stream(provider: Optional[str], system_prompt: str, messages: List[Dict[str, str]], model_name_hint: Optional[str] = None, model_name: Optional[str] = None, max_tokens: int = 512, session: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:  
+    msgs = [{"role": "system", "content": system_prompt}] + messages  
+    chosen = resolve_provider(provider, model_name)  
+    logger.info("choose_and_stream: model_name=%s -> provider=%s (hint=%s)", model_name, chosen, model_name_hint)  
+    stream = router.stream(chosen, model_name_hint, lambda name, model: _open_stream(name, msgs, model, max_tokens, session))  
+    async with aclosing(stream):  
+        async for delta in stream:  
+            yield delta
\ No newline at end of file
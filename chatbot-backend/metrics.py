@@ -0,0 +1,161 @@
+import os
+import time
+import bisect
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Sequence, Tuple, Iterator, Iterable, Callable
+
+logger = logging.getLogger(__name__)
+
+SLOW_TURN_MS = float(os.getenv("SLOW_TURN_MS", "0"))
+# model names that may appear as label values as-is; model names come from clients (model_hint), so anything not
+# listed here or in a registered source is reported as "other" and cannot grow the series without bound
+METRICS_MODELS = os.getenv("METRICS_MODELS", "gpt-4o,gpt-4o-mini,llama2,llama3,mistral")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry: List["_Metric"] = []
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # per-bucket (non-cumulative) counts, then sum and count
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            running = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                running += c
+                le = f'le="{_num(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {running}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+_known_models = {m.strip() for m in METRICS_MODELS.split(",") if m.strip()}
+_model_sources: List[Callable[[], Iterable[str]]] = []
+
+def add_model_source(source: Callable[[], Iterable[str]]) -> None:
+    # a callable returning more known model names (persona names, configured fallback models); it is asked on every
+    # lookup, so hot-reloaded config is picked up
+    _model_sources.append(source)
+
+def model_label(model: Optional[str]) -> str:
+    if not model:
+        return ""
+    if model in _known_models or any(model in source() for source in _model_sources):
+        return model
+    return "other"
+
+def render() -> str:
+    return "\n".join(line for m in _registry for line in m.render()) + "\n"
+
+TURN_SECONDS = Histogram("emochi_turn_seconds", "End-to-end chat turn latency.", ("persona", "outcome"))
+STAGE_SECONDS = Histogram("emochi_turn_stage_seconds", "Time spent per chat turn in each stage (storage, prompt, context, llm, emotion, style).", ("stage", "persona"), buckets=STAGE_BUCKETS)
+SLOW_TURNS = Counter("emochi_slow_turns_total", "Chat turns slower than SLOW_TURN_MS.", ("persona",))
+PROVIDER_SECONDS = Histogram("emochi_provider_call_seconds", "Latency of individual LLM provider calls.", ("provider", "model", "outcome"))
+PROVIDER_TOKENS = Counter("emochi_provider_tokens_total", "Tokens reported by LLM providers.", ("provider", "model", "kind"))
+STORAGE_BYTES = Counter("emochi_storage_bytes_total", "Bytes read from and written to chat storage.", ("op",))
+
+@contextmanager
+def provider_span(provider: str, model: Optional[str]) -> Iterator[None]:
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        # hedged losers and streams abandoned by the client
+        outcome = "cancelled"
+        raise
+    finally:
+        PROVIDER_SECONDS.observe(time.perf_counter() - start, provider=provider, model=model_label(model), outcome=outcome)
+
+def record_tokens(provider: str, model: Optional[str], prompt: Optional[int] = None, completion: Optional[int] = None) -> None:
+    if prompt:
+        PROVIDER_TOKENS.inc(prompt, provider=provider, model=model_label(model), kind="prompt")
+    if completion:
+        PROVIDER_TOKENS.inc(completion, provider=provider, model=model_label(model), kind="completion")
+
+def record_storage(op: str, nbytes: int) -> None:
+    STORAGE_BYTES.inc(nbytes, op=op)
+
+def record_turn(chat_id: str, persona: str, timings: Dict[str, float], total_ms: float, outcome: str = "ok") -> None:
+    # imported chats can carry any model name
+    persona = model_label(persona)
+    TURN_SECONDS.observe(total_ms / 1000, persona=persona, outcome=outcome)
+    for stage, ms in timings.items():
+        STAGE_SECONDS.observe(ms / 1000, stage=stage, persona=persona)
+    if SLOW_TURN_MS and total_ms >= SLOW_TURN_MS:
+        SLOW_TURNS.inc(persona=persona)
+        breakdown = " ".join(f"{k}={v:.1f}ms" for k, v in sorted(timings.items(), key=lambda kv: -kv[1]))
+        logger.warning("Slow turn chat=%s persona=%s outcome=%s total=%.1fms: %s", chat_id, persona, outcome, total_ms, breakdown)
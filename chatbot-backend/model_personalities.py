@@ -1,4 +1,9 @@
-model_personalities = {
+from typing import Dict
+
+from config_watch import WatchedConfig, str_map
+
+# built-in fallback; the live definitions come from model_personalities.json and are reloaded when it changes
+DEFAULT_MODEL_PERSONALITIES = {
     "Vanilla": "You are smooth, friendly, neutral, and helpful. Neutral tone, balanced detail.",
     "Vanilla Short": "Short, clever, fast responses. Witty and concise.",
     "Matcha": "Extremely descriptive narrator; rich sensory detail and action description for roleplay.",
@@ -11,4 +16,13 @@ model_personalities = {
     "Rainbow": "Vivid, hyper-expressive characters. Energetic and colorful reactions.",
     "Unicorn": "Epic, exhaustive detail and worldbuilding. Very long responses.",
     "Sage": "High-memory, thoughtful, philosophical, and structured narrative control."
-}
\ No newline at end of file
+}
+
+_personalities = WatchedConfig("model_personalities.json", DEFAULT_MODEL_PERSONALITIES, str_map)
+
+def get_model_personalities() -> Dict[str, str]:
+    return _personalities.get()
+
+def personalities_version() -> int:
+    _personalities.get()
+    return _personalities.version
\ No newline at end of file
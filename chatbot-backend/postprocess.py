@@ -0,0 +1,103 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional, Callable
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+POSTPROCESS_QUEUE_SIZE = int(os.getenv("POSTPROCESS_QUEUE_SIZE", "1000"))
+
+POSTPROCESS_SECONDS = metrics.Histogram("emochi_postprocess_seconds", "Time from a turn's reply being ready to its background work finishing.", ("outcome",))
+
+Hook = Callable[[Dict[str, Any]], None]
+
+class Pipeline:
+    # background work that runs after a reply has been returned. Jobs for one chat run strictly in submit order
+    # (each waits for the chat's previous job); jobs for different chats run concurrently in the default executor.
+    # At most max_pending jobs are queued; past that, submit waits, so a slow store slows turns instead of piling up.
+    def __init__(self, max_pending: int = POSTPROCESS_QUEUE_SIZE) -> None:
+        self.max_pending = max(1, max_pending)
+        self._hooks: List[Hook] = []
+        self._reset(None)
+
+    def _reset(self, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        self._loop = loop
+        self._tails: Dict[str, asyncio.Task] = {}
+        self._pending = 0
+        self._room: Optional[asyncio.Event] = None
+
+    def _bind(self) -> None:
+        # jobs belong to one event loop; a new loop (CLI runs, tests) starts with an empty queue
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._reset(loop)
+            self._room = asyncio.Event()
+
+    def add_hook(self, fn: Hook) -> None:
+        # called in a worker thread with each finished turn, after it has been persisted
+        self._hooks.append(fn)
+
+    def run_hooks(self, event: Dict[str, Any]) -> None:
+        for fn in self._hooks:
+            try:
+                fn(event)
+            except Exception:
+                logger.exception("Post-processing hook %r failed for chat %s", fn, event.get("chat_id"))
+
+    async def submit(self, chat_id: str, fn: Callable[..., Any], *args: Any) -> None:
+        self._bind()
+        while self._pending >= self.max_pending:
+            self._room.clear()
+            await self._room.wait()
+        prev = self._tails.get(chat_id)
+        task = asyncio.create_task(self._run(chat_id, prev, fn, args, time.perf_counter()))
+        self._tails[chat_id] = task
+        self._pending += 1
+        task.add_done_callback(lambda t: self._done(chat_id, t))
+
+    async def _run(self, chat_id: str, prev: Optional[asyncio.Task], fn: Callable[..., Any], args: tuple, queued: float) -> None:
+        if prev is not None:
+            # asyncio.wait never raises, so one failed job does not stop the chat's later ones
+            await asyncio.wait([prev])
+        outcome = "ok"
+        try:
+            await asyncio.to_thread(fn, *args)
+        except Exception:
+            outcome = "error"
+            logger.exception("Post-processing failed for chat %s", chat_id)
+        finally:
+            POSTPROCESS_SECONDS.observe(time.perf_counter() - queued, outcome=outcome)
+
+    def _done(self, chat_id: str, task: asyncio.Task) -> None:
+        self._pending -= 1
+        if self._tails.get(chat_id) is task:
+            del self._tails[chat_id]
+        if self._room is not None:
+            self._room.set()
+
+    async def wait(self, chat_id: str) -> None:
+        # the next turn of a chat calls this first, so it always sees the previous turn's persisted state. This only
+        # orders turns within one process; with a storage backend shared by several workers, rp_engine saves the turn
+        # before replying and submits just the hooks here
+        if self._loop is not asyncio.get_running_loop():
+            return
+        task = self._tails.get(chat_id)
+        if task is not None:
+            await asyncio.wait([task])
+
+    async def drain(self) -> None:
+        if self._loop is not asyncio.get_running_loop():
+            return
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"pending": self._pending, "chats": len(self._tails), "max_pending": self.max_pending}
+
+pipeline = Pipeline()
+
+def add_hook(fn: Hook) -> None:
+    pipeline.add_hook(fn)
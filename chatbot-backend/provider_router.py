@@ -0,0 +1,218 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable, AsyncIterator
+
+from metrics import model_label
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_FAILOVER_CHAIN = [p.strip().lower() for p in os.getenv("PROVIDER_FAILOVER_CHAIN", "ollama,openai,emergent").split(",") if p.strip()]
+# the model each provider is called with when it serves as a fallback; the primary's model name (an Ollama tag, a
+# persona) means nothing to the others. Providers not listed get None and use their own default
+PROVIDER_FALLBACK_MODELS = os.getenv("PROVIDER_FALLBACK_MODELS", "openai=gpt-4o,claude=gpt-4o,gemini=gpt-4o,ollama=llama2")
+PROVIDER_HEALTH_WINDOW = int(os.getenv("PROVIDER_HEALTH_WINDOW", "50"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+PROVIDER_HEDGE = os.getenv("PROVIDER_HEDGE", "false").lower() in ("1", "true", "yes")
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# (provider, model) -> completion; the model is the one to call the provider with
+Invoke = Callable[[str, Optional[str]], Awaitable[str]]
+Candidate = Tuple[str, Optional[str]]
+
+def parse_models(spec: Optional[str]) -> Dict[str, str]:
+    models = {}
+    for item in (spec or "").split(","):
+        name, _, model = item.partition("=")
+        if name.strip() and model.strip():
+            models[name.strip().lower()] = model.strip()
+    return models
+
+class ProviderHealth:
+    def __init__(self, name: str, window: int = PROVIDER_HEALTH_WINDOW) -> None:
+        self.name = name
+        self.calls: deque = deque(maxlen=window)
+        self.latencies: deque = deque(maxlen=window)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= CIRCUIT_COOLDOWN:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self.probing:
+                # exactly one trial request decides whether the circuit closes again
+                self.probing = True
+                return True
+            return False
+
+    def record(self, ok: bool, latency: Optional[float] = None) -> None:
+        with self._lock:
+            self.calls.append(ok)
+            if ok and latency is not None:
+                self.latencies.append(latency)
+            if self.state == HALF_OPEN:
+                self.probing = False
+                if ok:
+                    self.state = CLOSED
+                    self.calls.clear()
+                else:
+                    self._open()
+                return
+            errors = self.calls.count(False)
+            if self.state == CLOSED and len(self.calls) >= CIRCUIT_MIN_CALLS and errors / len(self.calls) >= CIRCUIT_ERROR_RATE:
+                self._open()
+
+    def _open(self) -> None:
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        logger.warning("Circuit for %s opened (error rate %.2f over %d calls)", self.name, self.error_rate(), len(self.calls))
+
+    def error_rate(self) -> float:
+        return self.calls.count(False) / len(self.calls) if self.calls else 0.0
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self.latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {"state": self.state, "calls": len(self.calls), "error_rate": round(self.error_rate(), 3), "p50_ms": None if p50 is None else round(p50 * 1000), "p95_ms": None if p95 is None else round(p95 * 1000)}
+
+class ProviderRouter:
+    def __init__(self, chain: Optional[List[str]] = None, hedge: bool = PROVIDER_HEDGE, fallback_models: Optional[Dict[str, str]] = None) -> None:
+        self.chain = chain if chain is not None else PROVIDER_FAILOVER_CHAIN
+        self.hedge = hedge
+        self.fallback_models = fallback_models if fallback_models is not None else parse_models(PROVIDER_FALLBACK_MODELS)
+        self.health: Dict[Tuple[str, str], ProviderHealth] = {}
+        self.available: Callable[[str], bool] = lambda provider: True
+        self._lock = threading.Lock()
+
+    def _health(self, provider: str, model: Optional[str]) -> ProviderHealth:
+        # keyed like the metrics: unknown (client-supplied) model names share one "other" entry per provider
+        model = model_label(model)
+        key = (provider, model)
+        with self._lock:
+            h = self.health.get(key)
+            if h is None:
+                h = self.health[key] = ProviderHealth(f"{provider}/{model}" if model else provider)
+            return h
+
+    def candidates(self, primary: str, model: Optional[str] = None) -> List[Candidate]:
+        # the primary is always tried, with the requested model; fallbacks that are not configured at all are skipped
+        # rather than counted as failures, and each is called with its own fallback model
+        return [(primary, model)] + [(p, self.fallback_models.get(p)) for p in self.chain if p != primary and self.available(p)]
+
+    async def _attempt(self, provider: str, model: Optional[str], invoke: Invoke) -> str:
+        # health is tracked under the model actually called
+        h = self._health(provider, model)
+        start = time.monotonic()
+        try:
+            result = await invoke(provider, model)
+        except asyncio.CancelledError:
+            # a losing hedge is cancelled on purpose; release a half-open probe without counting a failure
+            h.probing = False
+            raise
+        except Exception:
+            h.record(False, time.monotonic() - start)
+            raise
+        h.record(True, time.monotonic() - start)
+        return result
+
+    async def _hedged(self, first: Candidate, second: Candidate, invoke: Invoke, delay: float, tried: set) -> str:
+        primary = asyncio.ensure_future(self._attempt(*first, invoke))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self._health(*second).allow():
+            return await primary
+        logger.info("Hedging %s with %s after %.0fms", first[0], second[0], delay * 1000)
+        tried.add(second[0])
+        backup = asyncio.ensure_future(self._attempt(*second, invoke))
+        pending = {primary, backup}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(self, primary: str, model: Optional[str], invoke: Invoke) -> str:
+        errors: List[str] = []
+        tried: set = set()
+        order = self.candidates(primary, model)
+        for i, (provider, provider_model) in enumerate(order):
+            if provider in tried:
+                continue
+            h = self._health(provider, provider_model)
+            if not h.allow():
+                errors.append(f"{provider}: circuit open")
+                continue
+            try:
+                p95 = h.percentile(0.95) if self.hedge and len(h.latencies) >= HEDGE_MIN_SAMPLES else None
+                backup = order[i + 1] if i + 1 < len(order) else None
+                if p95 is not None and backup is not None:
+                    return await self._hedged(order[i], backup, invoke, p95, tried)
+                return await self._attempt(provider, provider_model, invoke)
+            except Exception as e:
+                logger.warning("Provider %s failed (%s); trying next in chain", provider, e)
+                errors.append(f"{provider}: {e}")
+        raise RuntimeError("All providers failed: " + "; ".join(errors))
+
+    async def stream(self, primary: str, model: Optional[str], open_stream: Callable[[str, Optional[str]], AsyncIterator[str]]) -> AsyncIterator[str]:
+        # failover is only possible before the first chunk; after that the client has already seen output
+        errors: List[str] = []
+        for provider, provider_model in self.candidates(primary, model):
+            h = self._health(provider, provider_model)
+            if not h.allow():
+                errors.append(f"{provider}: circuit open")
+                continue
+            started = False
+            stream = open_stream(provider, provider_model)
+            try:
+                async for chunk in stream:
+                    if not started:
+                        # time-to-first-token is not comparable with full-call latency, so only the outcome is recorded
+                        started = True
+                        h.record(True)
+                    yield chunk
+                if not started:
+                    h.record(True)
+                return
+            except (asyncio.CancelledError, GeneratorExit):
+                h.probing = False
+                raise
+            except Exception as e:
+                if started:
+                    raise
+                h.record(False)
+                logger.warning("Provider %s failed (%s); trying next in chain", provider, e)
+                errors.append(f"{provider}: {e}")
+            finally:
+                await stream.aclose()
+        raise RuntimeError("All providers failed: " + "; ".join(errors))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            items = list(self.health.items())
+        return {h.name: h.snapshot() for _, h in items}
+
+router = ProviderRouter()
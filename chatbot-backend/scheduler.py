@@ -0,0 +1,196 @@
+# Admission control for LLM calls: per-provider and per-model concurrency limits, a bounded fair-share queue, and a
+# per-chat cap on turns in flight. All of this state lives in the worker process's memory, so every limit here is
+# per worker: with STORAGE_BACKEND=sqlite and N workers, a provider can see up to N x PROVIDER_CONCURRENCY calls at
+# once, and likewise for MODEL_CONCURRENCY, SCHED_QUEUE_SIZE and SCHED_MAX_PER_CHAT. Divide the configured values by
+# the worker count to cap the total.
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_CONCURRENCY = os.getenv("PROVIDER_CONCURRENCY", "ollama=2")
+MODEL_CONCURRENCY = os.getenv("MODEL_CONCURRENCY", "")
+SCHED_DEFAULT_CONCURRENCY = int(os.getenv("SCHED_DEFAULT_CONCURRENCY", "16"))
+SCHED_QUEUE_SIZE = int(os.getenv("SCHED_QUEUE_SIZE", "64"))
+SCHED_QUEUE_TIMEOUT = float(os.getenv("SCHED_QUEUE_TIMEOUT", "20"))
+SCHED_MAX_PER_CHAT = int(os.getenv("SCHED_MAX_PER_CHAT", "4"))
+
+QUEUE_SECONDS = metrics.Histogram("emochi_scheduler_wait_seconds", "Time turns spend queued for a provider slot.", ("provider",))
+REJECTED = metrics.Counter("emochi_scheduler_rejected_total", "Turns rejected by admission control.", ("provider", "reason"))
+
+def parse_limits(spec: Optional[str]) -> Dict[str, int]:
+    # "ollama=2,openai=8" (providers) or "ollama/llama3=1" (models); names are case-insensitive
+    limits = {}
+    for item in (spec or "").split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            limits[name.strip().lower()] = max(1, int(value))
+    return limits
+
+class Overloaded(RuntimeError):
+    # status 429: this chat already has too many turns in flight; 503: the provider's queue is full or the wait expired
+    def __init__(self, message: str, status: int = 503, retry_after: int = 1) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+ModelKey = Tuple[str, str]
+
+class _Waiter:
+    __slots__ = ("key", "chat_id", "future")
+
+    def __init__(self, key: ModelKey, chat_id: str, future: asyncio.Future) -> None:
+        self.key = key
+        self.chat_id = chat_id
+        self.future = future
+
+class _Lane:
+    # one provider: running count, its limit, and the queued waiters grouped by chat in round-robin order
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.running = 0
+        self.queued = 0
+        self.waiting: "OrderedDict[str, deque]" = OrderedDict()
+        # EWMA of how long a slot is held, for Retry-After estimates
+        self.service = 5.0
+
+class Scheduler:
+    def __init__(self, provider_limits: Optional[Dict[str, int]] = None, model_limits: Optional[Dict[str, int]] = None, default_limit: int = SCHED_DEFAULT_CONCURRENCY, queue_size: int = SCHED_QUEUE_SIZE, queue_timeout: float = SCHED_QUEUE_TIMEOUT, max_per_chat: int = SCHED_MAX_PER_CHAT) -> None:
+        self.provider_limits = provider_limits if provider_limits is not None else parse_limits(PROVIDER_CONCURRENCY)
+        self.model_limits = model_limits if model_limits is not None else parse_limits(MODEL_CONCURRENCY)
+        self.default_limit = max(1, default_limit)
+        self.queue_size = max(0, queue_size)
+        self.queue_timeout = queue_timeout
+        self.max_per_chat = max_per_chat
+        self._lanes: Dict[str, _Lane] = {}
+        self._model_running: Dict[ModelKey, int] = {}
+        self._chat_active: Dict[str, int] = {}
+
+    def _lane(self, provider: str) -> _Lane:
+        lane = self._lanes.get(provider)
+        if lane is None:
+            lane = self._lanes[provider] = _Lane(self.provider_limits.get(provider, self.default_limit))
+        return lane
+
+    def _model_free(self, key: ModelKey) -> bool:
+        limit = self.model_limits.get(f"{key[0]}/{key[1]}")
+        return limit is None or self._model_running.get(key, 0) < limit
+
+    def _retry_after(self, lane: _Lane) -> int:
+        return max(1, min(60, math.ceil(lane.service * (lane.queued + 1) / lane.limit)))
+
+    def _reject(self, provider: str, lane: _Lane, reason: str, message: str, status: int) -> Overloaded:
+        REJECTED.inc(provider=provider, reason=reason)
+        return Overloaded(message, status, self._retry_after(lane))
+
+    def check(self, provider: str, model: str, chat_id: str = "") -> None:
+        # the part of admission that needs no waiting; raises Overloaded when acquire() would reject immediately
+        lane = self._lane(provider)
+        if chat_id and self.max_per_chat and self._chat_active.get(chat_id, 0) >= self.max_per_chat:
+            raise self._reject(provider, lane, "chat", f"Too many turns in flight for chat {chat_id}", 429)
+        if (lane.running >= lane.limit or lane.waiting) and lane.queued >= self.queue_size:
+            raise self._reject(provider, lane, "queue_full", f"{provider} is at capacity; try again shortly", 503)
+
+    async def acquire(self, provider: str, model: str, chat_id: str = "") -> None:
+        lane = self._lane(provider)
+        key = (provider, (model or "").lower())
+        self.check(provider, model, chat_id)
+        start = time.monotonic()
+        self._chat_active[chat_id] = self._chat_active.get(chat_id, 0) + 1
+        if lane.running < lane.limit and not lane.waiting and self._model_free(key):
+            self._start(lane, key)
+            QUEUE_SECONDS.observe(0.0, provider=provider)
+            return
+        waiter = _Waiter(key, chat_id, asyncio.get_running_loop().create_future())
+        lane.waiting.setdefault(chat_id, deque()).append(waiter)
+        lane.queued += 1
+        # the queue ahead may be held back only by model limits; if this turn's model has room it starts now
+        self._dispatch(lane)
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except BaseException as e:
+            granted = waiter.future.done() and not waiter.future.cancelled()
+            if granted:
+                # the slot was handed over just as the wait ended; give it to the next waiter
+                self._finish(lane, key, chat_id)
+            else:
+                self._chat_done(chat_id)
+                self._unqueue(lane, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject(provider, lane, "timeout", f"Timed out after {self.queue_timeout:.0f}s waiting for {provider}", 503)
+            raise
+        finally:
+            QUEUE_SECONDS.observe(time.monotonic() - start, provider=provider)
+
+    def _unqueue(self, lane: _Lane, waiter: _Waiter) -> None:
+        q = lane.waiting.get(waiter.chat_id)
+        if q is not None and waiter in q:
+            q.remove(waiter)
+            lane.queued -= 1
+            if not q:
+                del lane.waiting[waiter.chat_id]
+
+    def _start(self, lane: _Lane, key: ModelKey) -> None:
+        lane.running += 1
+        self._model_running[key] = self._model_running.get(key, 0) + 1
+
+    def _chat_done(self, chat_id: str) -> None:
+        n = self._chat_active.get(chat_id, 0) - 1
+        if n > 0:
+            self._chat_active[chat_id] = n
+        else:
+            self._chat_active.pop(chat_id, None)
+
+    def _finish(self, lane: _Lane, key: ModelKey, chat_id: str) -> None:
+        lane.running -= 1
+        n = self._model_running.get(key, 0) - 1
+        if n > 0:
+            self._model_running[key] = n
+        else:
+            self._model_running.pop(key, None)
+        self._chat_done(chat_id)
+        self._dispatch(lane)
+
+    def _dispatch(self, lane: _Lane) -> None:
+        # fair share: each free slot goes to the oldest waiter of the next chat in round-robin order whose model has
+        # room, so one chat with many queued turns (a batch, a retry storm) cannot starve the others
+        while lane.running < lane.limit and lane.waiting:
+            for chat_id in list(lane.waiting):
+                q = lane.waiting[chat_id]
+                waiter = q[0]
+                # a waiter whose wait just timed out or was cancelled is dropped here; acquire() sees it gone
+                stale = waiter.future.done()
+                if not stale and not self._model_free(waiter.key):
+                    continue
+                q.popleft()
+                lane.queued -= 1
+                if q:
+                    lane.waiting.move_to_end(chat_id)
+                else:
+                    del lane.waiting[chat_id]
+                if stale:
+                    break
+                self._start(lane, waiter.key)
+                waiter.future.set_result(None)
+                break
+            else:
+                # every queued chat is waiting on a model limit; the next release on that model dispatches again
+                return
+
+    def release(self, provider: str, model: str, chat_id: str = "", held: Optional[float] = None) -> None:
+        lane = self._lane(provider)
+        if held is not None:
+            lane.service = 0.8 * lane.service + 0.2 * held
+        self._finish(lane, (provider, (model or "").lower()), chat_id)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: {"running": lane.running, "queued": lane.queued, "limit": lane.limit, "chats_waiting": len(lane.waiting)} for name, lane in self._lanes.items()}
+
+scheduler = Scheduler()
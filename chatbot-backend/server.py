@@ -1,20 +1,43 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File  
+from fastapi import FastAPI, Depends, HTTPException, Header, Query, Request, Response  
 from fastapi.middleware.cors import CORSMiddleware  
+from fastapi.responses import StreamingResponse  
+from fastapi.concurrency import run_in_threadpool  
 from pydantic import BaseModel  
 from typing import List, Optional, Dict, Any  
 from dotenv import load_dotenv  
 import os  
+import hmac  
+import gzip  
+import json  
+import asyncio  
 import logging  
-import shutil  
   
 load_dotenv()  
   
-from rp_engine import generate_reply, set_model, set_settings, set_wallpaper, get_state  
-from storage import get_chat_dir  
+from rp_engine import generate_reply, stream_reply, check_admission, set_model, set_settings, set_wallpaper, get_state_page, state_version  
+import state_cache  
+from state_cache import offload  
+import llm_backends  
+import metrics  
+import blob_store  
+from idempotency import coalescer, fingerprint, IdempotencyConflict  
+from blob_store import BlobTooLarge, MalformedUpload  
+import storage  
+from storage import valid_chat_id, MAX_MESSAGES  
+import batch  
+import postprocess  
+from scheduler import scheduler, Overloaded  
+from llm_backends import UnknownProvider  
+from model_personalities import get_model_personalities  
+from tag_personalities import get_tags  
   
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')  
 logger = logging.getLogger(__name__)  
   
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))  
+# bulk endpoints (/export, /import, /batch/generate) are disabled unless this is set  
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  
+  
 app = FastAPI(title="Emochi Chatbot Backend", description="Multi-provider LLM backend with personality models and emotion tracking", version="1.0.0")  
   
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])  
@@ -23,6 +46,7 @@ class MessageRequest(BaseModel):
     text: str  
     provider: Optional[str] = None  
     model_hint: Optional[str] = None  
+    client_message_id: Optional[str] = None  
   
 class MessageResponse(BaseModel):  
     chat_id: str  
@@ -33,6 +57,12 @@ class MessageResponse(BaseModel):
 class ModelRequest(BaseModel):  
     model: str  
   
+class BatchRequest(BaseModel):  
+    jobs: List[Dict[str, Any]]  
+    checkpoint: Optional[str] = None  
+    concurrency: Optional[Dict[str, int]] = None  
+    default_concurrency: Optional[int] = None  
+  
 class SettingsRequest(BaseModel):  
     intro: Optional[str] = None  
     personality: Optional[str] = None  
@@ -40,6 +70,55 @@ class SettingsRequest(BaseModel):
     tags: Optional[List[str]] = None  
     gender: Optional[str] = None  
   
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:  
+    if not if_none_match:  
+        return False  
+    tag = etag.removeprefix("W/")  
+    return if_none_match.strip() == "*" or tag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]  
+  
+def _json_response(request: Request, data: Any, version: Optional[str] = None) -> Response:  
+    # state bodies carry up to MAX_MESSAGES messages: answer unchanged polls with 304 and gzip the rest. Only these  
+    # responses are compressed; a global GZipMiddleware would buffer the SSE/NDJSON streams and recompress images  
+    headers = {"Vary": "Accept-Encoding"}  
+    if version is not None:  
+        # weak because the same version may be sent gzipped or not  
+        headers["ETag"] = f'W/"{version}"'  
+        headers["Cache-Control"] = "no-cache"  
+        if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):  
+            return Response(status_code=304, headers=headers)  
+    body = json.dumps(data, ensure_ascii=False).encode("utf-8")  
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in request.headers.get("accept-encoding", "").lower():  
+        body = gzip.compress(body, compresslevel=6)  
+        headers["Content-Encoding"] = "gzip"  
+    return Response(content=body, media_type="application/json", headers=headers)  
+  
+@app.on_event("startup")  
+async def start_archiver():  
+    storage.start_archiver()  
+  
+@app.on_event("startup")  
+async def note_scheduler_limits():  
+    if storage.backend.shared:  
+        # several workers may share this backend, but scheduler limits are counted in each process separately  
+        logger.info(f"Scheduler limits apply per worker process: providers {scheduler.provider_limits}, models {scheduler.model_limits}, {scheduler.max_per_chat} turns per chat")  
+  
+@app.on_event("shutdown")  
+async def stop_archiver():  
+    storage.stop_archiver()  
+  
+@app.on_event("shutdown")  
+async def drain_postprocessing():  
+    # registered first so queued turns reach the state cache before it is flushed  
+    await postprocess.pipeline.drain()  
+  
+@app.on_event("shutdown")  
+async def flush_state_cache():  
+    state_cache.shutdown()  
+  
+@app.on_event("shutdown")  
+async def close_llm_clients():  
+    await llm_backends.aclose()  
+  
 @app.get("/")  
 async def root():  
     return {"status": "ok", "app": "Emochi Chatbot Backend", "version": "1.0.0"}  
@@ -49,22 +128,66 @@ async def health_check():
     openai_key_status = "Loaded" if os.getenv("OPENAI_API_KEY") else "MISSING"  
     anthropic_key_status = "Loaded" if os.getenv("ANTHROPIC_API_KEY") else "MISSING"  
     google_key_status = "Loaded" if os.getenv("GOOGLE_API_KEY") else "MISSING"  
-    return {"status": "ok", "app": "Emochi Chatbot Backend", "config_check": {"openai_key": openai_key_status, "anthropic_key": anthropic_key_status, "google_key": google_key_status, "ollama_url": os.getenv("OLLAMA_URL", "http://localhost:11434")}}  
+    return {"status": "ok", "app": "Emochi Chatbot Backend", "config_check": {"openai_key": openai_key_status, "anthropic_key": anthropic_key_status, "google_key": google_key_status, "ollama_url": os.getenv("OLLAMA_URL", "http://localhost:11434")}, "providers": llm_backends.router.snapshot(), "postprocess": postprocess.pipeline.snapshot(), "scheduler": scheduler.snapshot()}  
+  
+@app.get("/metrics")  
+async def prometheus_metrics():  
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)  
+  
+def _overloaded(e: Overloaded) -> HTTPException:  
+    return HTTPException(status_code=e.status, detail=str(e), headers={"Retry-After": str(e.retry_after)})  
   
 @app.post("/chat/{chat_id}/message", response_model=MessageResponse)  
-async def send_message(chat_id: str, request: MessageRequest):  
+async def send_message(chat_id: str, request: MessageRequest, response: Response, idempotency_key: Optional[str] = Header(None)):  
     try:  
-        result = generate_reply(chat_id=chat_id, user_text=request.text, provider_override=request.provider, model_hint=request.model_hint)  
+        key = idempotency_key or request.client_message_id  
+        if key:  
+            # retries with the same key share one generation and one stored user message  
+            fp = fingerprint(request.text, request.provider, request.model_hint)  
+            result = await coalescer.run((chat_id, key), fp, lambda: generate_reply(chat_id=chat_id, user_text=request.text, provider_override=request.provider, model_hint=request.model_hint))  
+        else:  
+            result = await generate_reply(chat_id=chat_id, user_text=request.text, provider_override=request.provider, model_hint=request.model_hint)  
+        if result.get("timings"):  
+            response.headers["Server-Timing"] = ", ".join(f"{k};dur={v}" for k, v in result["timings"].items())  
         return MessageResponse(**result)  
+    except IdempotencyConflict as e:  
+        raise HTTPException(status_code=422, detail=str(e))  
+    except Overloaded as e:  
+        raise _overloaded(e)  
+    except UnknownProvider as e:  
+        raise HTTPException(status_code=400, detail=str(e))  
     except Exception as e:  
         logger.exception(f"Error generating reply for chat {chat_id}")  
         raise HTTPException(status_code=500, detail=str(e))  
   
+@app.post("/chat/{chat_id}/message/stream")  
+async def stream_message(chat_id: str, request: MessageRequest):  
+    # reject before the 200 goes out when we already know the turn cannot be admitted  
+    try:  
+        await check_admission(chat_id, request.provider, request.model_hint)  
+    except Overloaded as e:  
+        raise _overloaded(e)  
+    except UnknownProvider as e:  
+        raise HTTPException(status_code=400, detail=str(e))  
+    async def events():  
+        try:  
+            async for event in stream_reply(chat_id=chat_id, user_text=request.text, provider_override=request.provider, model_hint=request.model_hint):  
+                yield f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"  
+        except Overloaded as e:  
+            # queued behind the pre-check and then timed out or lost the race for the last queue slot  
+            yield f"event: error\ndata: {json.dumps({'type': 'error', 'detail': str(e), 'status': e.status, 'retry_after': e.retry_after})}\n\n"  
+        except Exception as e:  
+            logger.exception(f"Error streaming reply for chat {chat_id}")  
+            yield f"event: error\ndata: {json.dumps({'type': 'error', 'detail': str(e)})}\n\n"  
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})  
+  
 @app.post("/chat/{chat_id}/model")  
-async def update_model(chat_id: str, request: ModelRequest):  
+async def update_model(chat_id: str, request: ModelRequest, http_request: Request, changes_only: bool = Query(False)):  
     try:  
-        state = set_model(chat_id, request.model)  
-        return {"ok": True, "state": state}  
+        result = await offload(set_model, chat_id, request.model, changes_only=changes_only)  
+        if changes_only:  
+            return _json_response(http_request, {"ok": True, **result}, result["version"])  
+        return _json_response(http_request, {"ok": True, "state": result}, state_version(result))  
     except ValueError as e:  
         raise HTTPException(status_code=400, detail=str(e))  
     except Exception as e:  
@@ -72,45 +195,162 @@ async def update_model(chat_id: str, request: ModelRequest):
         raise HTTPException(status_code=500, detail=str(e))  
   
 @app.post("/chat/{chat_id}/settings")  
-async def update_settings(chat_id: str, request: SettingsRequest):  
+async def update_settings(chat_id: str, request: SettingsRequest, http_request: Request, changes_only: bool = Query(False)):  
     try:  
-        state = set_settings(chat_id=chat_id, intro=request.intro, personality=request.personality, welcome=request.welcome, tags=request.tags, gender=request.gender)  
-        return {"ok": True, "state": state}  
+        result = await offload(set_settings, chat_id=chat_id, intro=request.intro, personality=request.personality, welcome=request.welcome, tags=request.tags, gender=request.gender, changes_only=changes_only)  
+        if changes_only:  
+            return _json_response(http_request, {"ok": True, **result}, result["version"])  
+        return _json_response(http_request, {"ok": True, "state": result}, state_version(result))  
     except Exception as e:  
         logger.exception(f"Error updating settings for chat {chat_id}")  
         raise HTTPException(status_code=500, detail=str(e))  
   
 @app.get("/chat/{chat_id}/state")  
-async def get_chat_state(chat_id: str):  
+async def get_chat_state(chat_id: str, request: Request, since: Optional[str] = None, before: Optional[str] = None, limit: Optional[int] = Query(None, ge=1, le=MAX_MESSAGES)):  
+    # since=<message id>: only newer messages; before=<message id>&limit=n: older history, page by page  
+    if since is not None and before is not None:  
+        raise HTTPException(status_code=400, detail="Use either since or before, not both")  
     try:  
-        state = get_state(chat_id)  
-        return state  
+        state = await offload(get_state_page, chat_id, since=since, before=before, limit=limit)  
+        return _json_response(request, state, state["version"])  
     except Exception as e:  
         logger.exception(f"Error getting state for chat {chat_id}")  
         raise HTTPException(status_code=500, detail=str(e))  
   
 @app.post("/chat/{chat_id}/wallpaper")  
-async def upload_wallpaper(chat_id: str, file: UploadFile = File(...)):  
+async def upload_wallpaper(chat_id: str, request: Request):  
+    # multipart "file" field, or the raw image as the request body (optional X-Filename header)  
     try:  
-        chat_dir = get_chat_dir(chat_id)  
-        dest_path = os.path.join(chat_dir, file.filename)  
-        with open(dest_path, "wb") as buffer:  
-            shutil.copyfileobj(file.file, buffer)  
-        meta = {"filename": file.filename, "path": dest_path, "content_type": file.content_type}  
-        state = set_wallpaper(chat_id, meta)  
+        length = int(request.headers.get("content-length") or 0)  
+    except ValueError:  
+        raise HTTPException(status_code=400, detail="Invalid Content-Length header")  
+    try:  
+        if length > blob_store.WALLPAPER_MAX_BYTES + blob_store.MULTIPART_OVERHEAD:  
+            raise BlobTooLarge(f"Wallpaper exceeds the {blob_store.WALLPAPER_MAX_BYTES} byte limit")  
+        content_type = request.headers.get("content-type", "")  
+        if content_type.startswith("multipart/form-data"):  
+            # parsed as it streams in: a chunked or mislabelled body hits the limit as soon as it passes it  
+            part: Dict[str, Any] = {}  
+            blob = await blob_store.store(blob_store.multipart_file(request.stream(), content_type, part))  
+            filename = part["filename"]  
+        else:  
+            filename = request.headers.get("x-filename")  
+            blob = await blob_store.store(request.stream())  
+        meta = {"filename": filename, **blob}  
+        await offload(set_wallpaper, chat_id, meta)  
         return {"ok": True, "meta": meta}  
+    except BlobTooLarge as e:  
+        raise HTTPException(status_code=413, detail=str(e))  
+    except MalformedUpload as e:  
+        raise HTTPException(status_code=400, detail=str(e))  
+    except HTTPException:  
+        raise  
     except Exception as e:  
         logger.exception(f"Error uploading wallpaper for chat {chat_id}")  
         raise HTTPException(status_code=500, detail=str(e))  
   
+@app.api_route("/wallpapers/{sha}", methods=["GET", "HEAD"])  
+async def get_wallpaper(sha: str, request: Request):  
+    found = blob_store.open_blob(sha)  
+    if found is None:  
+        raise HTTPException(status_code=404, detail="Wallpaper not found")  
+    path, size, content_type = found  
+    etag = f'"{sha}"'  
+    # content-addressed, so a given URL never changes and can be cached forever  
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable", "Accept-Ranges": "bytes"}  
+    if _etag_matches(request.headers.get("if-none-match"), etag):  
+        return Response(status_code=304, headers=headers)  
+    range_header = request.headers.get("range")  
+    if_range = request.headers.get("if-range")  
+    if range_header and if_range and if_range.strip() != etag:  
+        range_header = None  
+    try:  
+        span = blob_store.parse_range(range_header, size)  
+    except ValueError:  
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})  
+    start, end = span or (0, size - 1)  
+    status = 206 if span else 200  
+    headers["Content-Length"] = str(end - start + 1)  
+    if span:  
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"  
+    if request.method == "HEAD":  
+        return Response(status_code=status, headers=headers, media_type=content_type)  
+    return StreamingResponse(blob_store.iter_file(path, start, end), status_code=status, headers=headers, media_type=content_type)  
+  
+def require_admin(authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)) -> None:  
+    # these routes reach every chat, so a chat id is not enough; accepts "Authorization: Bearer <token>" or X-Admin-Token  
+    if not ADMIN_TOKEN:  
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN or use the batch.py CLI")  
+    scheme, _, token = (authorization or "").partition(" ")  
+    supplied = x_admin_token or (token.strip() if scheme.lower() == "bearer" else "")  
+    if not supplied:  
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})  
+    if not hmac.compare_digest(supplied.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):  
+        raise HTTPException(status_code=403, detail="Invalid admin token")  
+  
+@app.get("/export", dependencies=[Depends(require_admin)])  
+async def export_chats(chat_id: Optional[List[str]] = Query(None)):  
+    if chat_id and not all(valid_chat_id(c) for c in chat_id):  
+        raise HTTPException(status_code=400, detail="Invalid chat id")  
+    return StreamingResponse(batch.export_chats(chat_id), media_type="application/x-ndjson")  
+  
+@app.post("/import", dependencies=[Depends(require_admin)])  
+async def import_chats(request: Request):  
+    # NDJSON of {"chat_id", "state"} as produced by /export, consumed line by line as it arrives  
+    imported, errors, buffer = 0, [], b""  
+    async def consume(line: bytes) -> None:  
+        nonlocal imported  
+        try:  
+            if await run_in_threadpool(batch.import_line, line.decode("utf-8")):  
+                imported += 1  
+        except ValueError as e:  
+            errors.append(str(e)[:300])  
+    async for chunk in request.stream():  
+        buffer += chunk  
+        *lines, buffer = buffer.split(b"\n")  
+        for line in lines:  
+            await consume(line)  
+    await consume(buffer)  
+    return {"ok": not errors, "imported": imported, "errors": errors[:50], "error_count": len(errors)}  
+  
+@app.post("/batch/generate", dependencies=[Depends(require_admin)])  
+async def batch_generate(request: BatchRequest):  
+    # streams NDJSON result/error/progress events and a final "done" summary; a dropped connection cancels the  
+    # run, and resending the same jobs with the same checkpoint name resumes it  
+    try:  
+        for job in request.jobs:  
+            batch.validate_job(job)  
+        checkpoint = batch.Checkpoint(batch.checkpoint_path(request.checkpoint)) if request.checkpoint else None  
+    except ValueError as e:  
+        raise HTTPException(status_code=400, detail=str(e))  
+    queue: asyncio.Queue = asyncio.Queue()  
+    async def run() -> None:  
+        try:  
+            await batch.run_batch(request.jobs, checkpoint, request.concurrency, request.default_concurrency or batch.BATCH_CONCURRENCY, queue.put_nowait)  
+        except Exception as e:  
+            logger.exception("Batch generation failed")  
+            queue.put_nowait({"type": "error", "error": str(e)})  
+        queue.put_nowait(None)  
+    async def events():  
+        task = asyncio.create_task(run())  
+        try:  
+            while True:  
+                event = await queue.get()  
+                if event is None:  
+                    break  
+                yield json.dumps(event, ensure_ascii=False) + "\n"  
+        finally:  
+            task.cancel()  
+    return StreamingResponse(events(), media_type="application/x-ndjson")  
+  
 @app.get("/models")  
 async def list_models():  
-    from model_personalities import model_personalities  
-    return {"models": list(model_personalities.keys()), "descriptions": model_personalities}  
+    personalities = get_model_personalities()  
+    return {"models": list(personalities.keys()), "descriptions": personalities}  
   
 @app.get("/tags")  
 async def list_tags():  
-    return {"tags": ["Flirty", "Romantic", "Dominant", "Submissive", "Seductive", "Taboo", "Dark Romance", "Tsundere", "Yandere", "Bratty", "Demon", "Cold"]}  
+    return {"tags": get_tags()}  
   
 if __name__ == "__main__":  
     import uvicorn  
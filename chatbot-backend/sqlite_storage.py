@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, List, Callable, Iterator, Optional, Tuple
+
+from metrics import record_storage
+
+SQLITE_BUSY_TIMEOUT = float(os.getenv("STORAGE_SQLITE_BUSY_TIMEOUT", "10"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    meta TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    msg_id TEXT NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_seq ON messages (chat_id, seq);
+CREATE INDEX IF NOT EXISTS messages_chat_msg ON messages (chat_id, msg_id);
+CREATE TABLE IF NOT EXISTS provider_sessions (
+    chat_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    session TEXT NOT NULL,
+    PRIMARY KEY (chat_id, model)
+);
+"""
+
+class SqliteStorage:
+    # WAL lets many worker processes read while one writes; every write is one short IMMEDIATE transaction
+    shared = True
+
+    def __init__(self, path: str, default_state: Callable[[str], Dict[str, Any]], max_messages: int, compact_threshold: int) -> None:
+        self.path = path
+        self.default_state = default_state
+        self.max_messages = max_messages
+        self.compact_threshold = compact_threshold
+        self._local = threading.local()
+        # executescript commits on its own, so it runs outside _transaction
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # one connection per thread; isolation_level=None so transactions are explicit
+            db = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self, write: bool = True) -> Iterator[sqlite3.Connection]:
+        db = self._connect()
+        # IMMEDIATE takes the write lock up front, so read-modify-write never fails halfway with SQLITE_BUSY
+        db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _load(self, db: sqlite3.Connection, chat_id: str) -> Dict[str, Any]:
+        row = db.execute("SELECT meta FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        st = json.loads(row[0]) if row else self.default_state(chat_id)
+        rows = db.execute("SELECT body FROM messages WHERE chat_id = ? ORDER BY seq DESC LIMIT ?", (chat_id, self.max_messages)).fetchall()
+        st["messages"] = [json.loads(r[0]) for r in reversed(rows)]
+        record_storage("read", (len(row[0]) if row else 0) + sum(len(r[0]) for r in rows))
+        return st
+
+    def _save_meta(self, db: sqlite3.Connection, chat_id: str, state: Dict[str, Any]) -> None:
+        meta = json.dumps({k: v for k, v in state.items() if k != "messages"}, ensure_ascii=False)
+        db.execute("INSERT INTO chats (chat_id, meta, updated_at) VALUES (?, ?, ?) ON CONFLICT (chat_id) DO UPDATE SET meta = excluded.meta, updated_at = excluded.updated_at", (chat_id, meta, time.time()))
+        record_storage("write", len(meta))
+
+    def _ensure_chat(self, db: sqlite3.Connection, chat_id: str) -> None:
+        meta = json.dumps({k: v for k, v in self.default_state(chat_id).items() if k != "messages"}, ensure_ascii=False)
+        db.execute("INSERT OR IGNORE INTO chats (chat_id, meta, updated_at) VALUES (?, ?, ?)", (chat_id, meta, time.time()))
+
+    def _trim(self, db: sqlite3.Connection, chat_id: str) -> int:
+        db.execute("DELETE FROM messages WHERE chat_id = ? AND seq < (SELECT seq FROM messages WHERE chat_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)", (chat_id, chat_id, self.max_messages - 1))
+        count = db.execute("SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+        db.execute("UPDATE chats SET message_count = ? WHERE chat_id = ?", (count, chat_id))
+        return count
+
+    def load_state(self, chat_id: str) -> Dict[str, Any]:
+        # a deferred read transaction gives meta and messages from one consistent snapshot
+        with self._transaction(write=False) as db:
+            return self._load(db, chat_id)
+
+    def load_meta(self, chat_id: str) -> Dict[str, Any]:
+        # one row; the messages table is not touched
+        row = self._connect().execute("SELECT meta FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return {k: v for k, v in self.default_state(chat_id).items() if k != "messages"}
+        record_storage("read", len(row[0]))
+        return json.loads(row[0])
+
+    def read_state(self, chat_id: str) -> Dict[str, Any]:
+        # nothing is ever archived here, so a bulk read is a plain read
+        return self.load_state(chat_id)
+
+    def load_page(self, chat_id: str, since: Optional[str] = None, before: Optional[str] = None, limit: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        # same contract as storage.page_messages, but only the requested rows are read
+        n = min(limit or self.max_messages, self.max_messages)
+        with self._transaction(write=False) as db:
+            row = db.execute("SELECT meta FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+            st = json.loads(row[0]) if row else self.default_state(chat_id)
+            last = db.execute("SELECT msg_id FROM messages WHERE chat_id = ? ORDER BY seq DESC LIMIT 1", (chat_id,)).fetchone()
+            info = {"last_id": last[0] if last else None, "has_more": False, "reset": False}
+            anchor = None
+            if since is not None or before is not None:
+                found = db.execute("SELECT seq FROM messages WHERE chat_id = ? AND msg_id = ?", (chat_id, since if since is not None else before)).fetchone()
+                anchor = found[0] if found else None
+            if since is not None and anchor is not None:
+                rows = db.execute("SELECT body FROM messages WHERE chat_id = ? AND seq > ? ORDER BY seq LIMIT ?", (chat_id, anchor, n + 1)).fetchall()
+                info["has_more"], rows = len(rows) > n, rows[:n]
+            elif before is not None and anchor is None:
+                rows = []
+            else:
+                info["reset"] = since is not None
+                upper = anchor if before is not None else -1
+                rows = db.execute("SELECT body FROM messages WHERE chat_id = ? AND (? < 0 OR seq < ?) ORDER BY seq DESC LIMIT ?", (chat_id, upper, upper, n + 1)).fetchall()
+                info["has_more"], rows = len(rows) > n, rows[:n][::-1]
+        st["messages"] = [json.loads(r[0]) for r in rows]
+        record_storage("read", (len(row[0]) if row else 0) + sum(len(r[0]) for r in rows))
+        return st, info
+
+    def save_state(self, chat_id: str, state: Dict[str, Any]) -> None:
+        with self._transaction() as db:
+            self._save_meta(db, chat_id, state)
+
+    def update_state(self, chat_id: str, fn: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:
+        with self._transaction() as db:
+            st = self._load(db, chat_id)
+            fn(st)
+            self._save_meta(db, chat_id, st)
+            return st
+
+    def append_messages(self, chat_id: str, messages: List[Dict[str, Any]]) -> None:
+        rows = [(chat_id, m["id"], json.dumps(m, ensure_ascii=False)) for m in messages]
+        with self._transaction() as db:
+            self._ensure_chat(db, chat_id)
+            db.executemany("INSERT INTO messages (chat_id, msg_id, body) VALUES (?, ?, ?)", rows)
+            db.execute("UPDATE chats SET message_count = message_count + ?, updated_at = ? WHERE chat_id = ?", (len(rows), time.time(), chat_id))
+            count = db.execute("SELECT message_count FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+            if count > self.compact_threshold:
+                self._trim(db, chat_id)
+        record_storage("append", sum(len(r[2]) for r in rows))
+
+    def load_session(self, chat_id: str, model: str) -> Dict[str, Any]:
+        row = self._connect().execute("SELECT session FROM provider_sessions WHERE chat_id = ? AND model = ?", (chat_id, model)).fetchone()
+        if row is None:
+            return {}
+        record_storage("read", len(row[0]))
+        return json.loads(row[0])
+
+    def save_session(self, chat_id: str, model: str, session: Dict[str, Any]) -> None:
+        body = json.dumps(session)
+        with self._transaction() as db:
+            db.execute("INSERT INTO provider_sessions (chat_id, model, session) VALUES (?, ?, ?) ON CONFLICT (chat_id, model) DO UPDATE SET session = excluded.session", (chat_id, model, body))
+        record_storage("write", len(body))
+
+    def compact_log(self, chat_id: str) -> int:
+        with self._transaction() as db:
+            return self._trim(db, chat_id)
+
+    def chat_ids(self) -> List[str]:
+        with self._transaction(write=False) as db:
+            return [r[0] for r in db.execute("SELECT chat_id FROM chats ORDER BY chat_id")]
+
+    def import_chat(self, chat_id: str, state: Dict[str, Any]) -> None:
+        messages = state.get("messages", [])[-self.max_messages:]
+        with self._transaction() as db:
+            db.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            self._save_meta(db, chat_id, state)
+            db.executemany("INSERT INTO messages (chat_id, msg_id, body) VALUES (?, ?, ?)", [(chat_id, m.get("id", ""), json.dumps(m, ensure_ascii=False)) for m in messages])
+            db.execute("UPDATE chats SET message_count = ? WHERE chat_id = ?", (len(messages), chat_id))
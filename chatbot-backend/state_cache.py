@@ -0,0 +1,316 @@
+import os
+import atexit
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Callable, Iterator, Tuple, TypeVar
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "1024"))
+STATE_CACHE_FLUSH_INTERVAL = float(os.getenv("STATE_CACHE_FLUSH_INTERVAL", "1.0"))
+STATE_CACHE_FLUSH_BATCH = int(os.getenv("STATE_CACHE_FLUSH_BATCH", "64"))
+
+class _Entry:
+    __slots__ = ("state", "lock", "io_lock", "dirty", "pending", "log_len", "evicted")
+
+    def __init__(self) -> None:
+        self.state: Optional[Dict[str, Any]] = None
+        self.lock = threading.Lock()
+        # serializes disk writes for one chat so batches reach the log in order
+        self.io_lock = threading.Lock()
+        self.dirty = False
+        self.pending: List[Dict[str, Any]] = []
+        self.log_len = 0
+        self.evicted = False
+
+def _snapshot(state: Dict[str, Any]) -> Dict[str, Any]:
+    # one level deep: message dicts are never mutated once appended, so they can be shared
+    return {k: (list(v) if isinstance(v, list) else dict(v) if isinstance(v, dict) else v) for k, v in state.items()}
+
+class StateCache:
+    def __init__(self, max_entries: int = STATE_CACHE_SIZE, flush_interval: float = STATE_CACHE_FLUSH_INTERVAL, flush_batch: int = STATE_CACHE_FLUSH_BATCH) -> None:
+        self.max_entries = max(1, max_entries)
+        self.flush_interval = flush_interval
+        self.flush_batch = max(1, flush_batch)
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty: set = set()
+        # evicted while their latest changes were still in memory: the flusher writes them out, and until then they
+        # stay reachable here so nobody reloads the chat from disk without them
+        self._retired: Dict[str, _Entry] = {}
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _entry(self, chat_id: str) -> _Entry:
+        with self._lock:
+            e = self._entries.get(chat_id)
+            if e is None:
+                e = self._retired.pop(chat_id, None) or _Entry()
+                self._entries[chat_id] = e
+            else:
+                self._entries.move_to_end(chat_id)
+            return e
+
+    @contextmanager
+    def _locked(self, chat_id: str) -> Iterator[_Entry]:
+        while True:
+            e = self._entry(chat_id)
+            with e.lock:
+                if e.evicted:
+                    continue
+                if e.state is None:
+                    e.state = storage.load_state(chat_id)
+                    e.log_len = len(e.state.get("messages", []))
+                yield e
+                break
+        self._evict()
+
+    def _mark_dirty(self, chat_id: str, e: _Entry) -> None:
+        e.dirty = True
+        with self._lock:
+            self._dirty.add(chat_id)
+            if len(self._dirty) >= self.flush_batch:
+                self._wake.set()
+        self._ensure_flusher()
+
+    def get_state(self, chat_id: str) -> Dict[str, Any]:
+        with self._locked(chat_id) as e:
+            return _snapshot(e.state)
+
+    def load_meta(self, chat_id: str) -> Dict[str, Any]:
+        # from the cached copy when there is one, else just the metadata from storage (nothing is cached)
+        with self._lock:
+            e = self._entries.get(chat_id) or self._retired.get(chat_id)
+        if e is not None:
+            with e.lock:
+                if e.state is not None and not e.evicted:
+                    return _snapshot({k: v for k, v in e.state.items() if k != "messages"})
+        return storage.load_meta(chat_id)
+
+    def load_page(self, chat_id: str, since: Optional[str] = None, before: Optional[str] = None, limit: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        # slices the cached window under the lock; only the requested messages are copied
+        with self._locked(chat_id) as e:
+            page, info = storage.page_messages(e.state["messages"], since, before, limit)
+            st = _snapshot({k: v for k, v in e.state.items() if k != "messages"})
+        st["messages"] = page
+        return st, info
+
+    def update_state(self, chat_id: str, fn: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:
+        with self._locked(chat_id) as e:
+            fn(e.state)
+            self._mark_dirty(chat_id, e)
+            return _snapshot(e.state)
+
+    def save_state(self, chat_id: str, state: Dict[str, Any]) -> None:
+        self.update_state(chat_id, lambda st: st.update({k: v for k, v in state.items() if k != "messages"}))
+
+    def append_message(self, chat_id: str, role: str, content: str, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        m = storage.new_message(role, content, meta)
+        with self._locked(chat_id) as e:
+            e.state["messages"].append(m)
+            e.state["messages"] = e.state["messages"][-storage.MAX_MESSAGES:]
+            e.pending.append(m)
+            self._mark_dirty(chat_id, e)
+        return m
+
+    def replace_state(self, chat_id: str, state: Dict[str, Any]) -> None:
+        # bulk import: overwrite storage and drop the cached copy so the next access reloads it
+        while True:
+            e = self._entry(chat_id)
+            with e.io_lock, e.lock:
+                if e.evicted:
+                    continue
+                storage.import_chat(chat_id, state)
+                e.state, e.pending, e.dirty = None, [], False
+                return
+
+    def _take(self, e: _Entry):
+        pending, e.pending = e.pending, []
+        e.dirty = False
+        return pending, {k: v for k, v in e.state.items() if k != "messages"}
+
+    def _persist(self, chat_id: str, e: _Entry, pending: List[Dict[str, Any]], meta: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        # returns the messages that still need writing, or None once everything reached disk
+        try:
+            if pending:
+                storage.append_messages(chat_id, pending)
+        except Exception:
+            logger.exception("Failed to flush messages for chat %s; will retry", chat_id)
+            return pending
+        e.log_len += len(pending)
+        try:
+            storage.save_state(chat_id, meta)
+            if e.log_len > storage.COMPACT_THRESHOLD:
+                e.log_len = storage.compact_log(chat_id)
+        except Exception:
+            logger.exception("Failed to flush metadata for chat %s; will retry", chat_id)
+            return []
+        return None
+
+    def _requeue(self, chat_id: str, e: _Entry, unsent: List[Dict[str, Any]]) -> None:
+        e.pending = unsent + e.pending
+        e.dirty = True
+        with self._lock:
+            self._dirty.add(chat_id)
+
+    def _flush_entry(self, chat_id: str, e: _Entry) -> None:
+        with e.io_lock:
+            with e.lock:
+                if not e.dirty or e.state is None:
+                    return
+                pending, meta = self._take(e)
+            unsent = self._persist(chat_id, e, pending, meta)
+            if unsent is not None:
+                with e.lock:
+                    self._requeue(chat_id, e, unsent)
+        if chat_id in self._retired:
+            self._settle(chat_id, e)
+
+    def _settle(self, chat_id: str, e: _Entry) -> None:
+        # a retired entry leaves for good once everything it held has been written
+        with e.lock, self._lock:
+            if self._retired.get(chat_id) is e and not e.dirty:
+                del self._retired[chat_id]
+                e.evicted = True
+
+    def flush(self, chat_id: str) -> None:
+        with self._lock:
+            e = self._entries.get(chat_id) or self._retired.get(chat_id)
+            self._dirty.discard(chat_id)
+        if e is not None:
+            self._flush_entry(chat_id, e)
+
+    def flush_all(self) -> int:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            found = ((c, self._entries.get(c) or self._retired.get(c)) for c in dirty)
+            entries = [(c, e) for c, e in found if e is not None]
+        for chat_id, e in entries:
+            self._flush_entry(chat_id, e)
+        return len(entries)
+
+    def _evict(self) -> None:
+        # no disk I/O here, it runs on the request path: entries with unwritten changes (or a flush still in flight)
+        # are retired and handed to the flusher, clean ones are dropped
+        retired = False
+        with self._lock:
+            for chat_id, e in list(self._entries.items()):
+                if len(self._entries) <= self.max_entries:
+                    break
+                if not e.lock.acquire(blocking=False):
+                    continue
+                try:
+                    del self._entries[chat_id]
+                    if e.state is not None and (e.dirty or e.io_lock.locked()):
+                        self._retired[chat_id] = e
+                        self._dirty.add(chat_id)
+                        retired = True
+                    else:
+                        e.evicted = True
+                        self._dirty.discard(chat_id)
+                finally:
+                    e.lock.release()
+        if retired:
+            self._wake.set()
+            self._ensure_flusher()
+
+    def _ensure_flusher(self) -> None:
+        if self._thread is not None or self._stop.is_set():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="state-cache-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush_all()
+            except Exception:
+                logger.exception("State cache flush failed")
+
+    def shutdown(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush_all()
+
+class WriteThrough:
+    # for backends shared by several worker processes: a process-local copy would go stale and its delayed
+    # flush would overwrite other workers' writes, so every call goes straight to the backend's transactions
+    def get_state(self, chat_id: str) -> Dict[str, Any]:
+        return storage.load_state(chat_id)
+
+    def load_meta(self, chat_id: str) -> Dict[str, Any]:
+        return storage.load_meta(chat_id)
+
+    def load_page(self, chat_id: str, since: Optional[str] = None, before: Optional[str] = None, limit: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        return storage.load_page(chat_id, since, before, limit)
+
+    def update_state(self, chat_id: str, fn: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:
+        return storage.update_state(chat_id, fn)
+
+    def save_state(self, chat_id: str, state: Dict[str, Any]) -> None:
+        self.update_state(chat_id, lambda st: st.update({k: v for k, v in state.items() if k != "messages"}))
+
+    def append_message(self, chat_id: str, role: str, content: str, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        return storage.append_message(chat_id, role, content, meta)
+
+    def replace_state(self, chat_id: str, state: Dict[str, Any]) -> None:
+        storage.import_chat(chat_id, state)
+
+    def flush(self, chat_id: str) -> None:
+        pass
+
+    def flush_all(self) -> int:
+        return 0
+
+    def shutdown(self) -> None:
+        pass
+
+cache = WriteThrough() if storage.backend.shared else StateCache()
+atexit.register(cache.shutdown)
+
+T = TypeVar("T")
+
+async def offload(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    # for async callers of the functions below, on either backend: write-through calls can wait out another worker's
+    # write lock, and a write-back cache miss reads (and may repair or rehydrate) the chat from disk while holding the
+    # chat's lock, so every call runs in a thread rather than on the event loop
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+def load_state(chat_id: str) -> Dict[str, Any]:
+    return cache.get_state(chat_id)
+
+def load_meta(chat_id: str) -> Dict[str, Any]:
+    return cache.load_meta(chat_id)
+
+def load_page(chat_id: str, since: Optional[str] = None, before: Optional[str] = None, limit: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    return cache.load_page(chat_id, since, before, limit)
+
+def save_state(chat_id: str, state: Dict[str, Any]) -> None:
+    cache.save_state(chat_id, state)
+
+def update_state(chat_id: str, fn: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:
+    return cache.update_state(chat_id, fn)
+
+def append_message(chat_id: str, role: str, content: str, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    return cache.append_message(chat_id, role, content, meta)
+
+def replace_state(chat_id: str, state: Dict[str, Any]) -> None:
+    cache.replace_state(chat_id, state)
+
+def flush_all() -> int:
+    return cache.flush_all()
+
+def shutdown() -> None:
+    cache.shutdown()
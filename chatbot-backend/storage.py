@@ -1,40 +1,505 @@
 import os  
+import re  
+import sys  
 import json  
+import time  
 import uuid  
+import shutil  
+import hashlib  
+import logging  
+import threading  
 from datetime import datetime, timezone  
-from typing import Dict, Any, Optional  
+from typing import Dict, Any, Optional, List, Callable, Tuple  
   
-BASE_DIR = os.path.join(os.path.dirname(__file__), "rp_data")  
+from metrics import record_storage  
+from archive import ChatArchive  
+  
+logger = logging.getLogger(__name__)  
+  
+BASE_DIR = os.getenv("RP_DATA_DIR", os.path.join(os.path.dirname(__file__), "rp_data"))  
 os.makedirs(BASE_DIR, exist_ok=True)  
   
+MAX_MESSAGES = 400  
+COMPACT_THRESHOLD = int(os.getenv("RP_COMPACT_THRESHOLD", str(MAX_MESSAGES * 2)))  
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "file").lower()  
+SQLITE_PATH = os.getenv("STORAGE_SQLITE_PATH", os.path.join(BASE_DIR, "emochi.db"))  
+CHATS_DIR = os.path.join(BASE_DIR, "chats")  
+ARCHIVE_DIR = os.getenv("RP_ARCHIVE_DIR", os.path.join(BASE_DIR, "archive"))  
+ARCHIVE_AFTER_DAYS = float(os.getenv("RP_ARCHIVE_AFTER_DAYS", "30"))  
+RETENTION_DAYS = float(os.getenv("RP_RETENTION_DAYS", "0"))  
+ARCHIVE_INTERVAL = float(os.getenv("RP_ARCHIVE_INTERVAL", "3600"))  
+ARCHIVE_SEGMENT_BYTES = int(os.getenv("RP_ARCHIVE_SEGMENT_BYTES", str(64 * 1024 * 1024)))  
+  
+_CHAT_ID_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.\-]{0,127}$")  
+  
+def valid_chat_id(chat_id: str) -> bool:  
+    # chat ids become directory names, so ids arriving in bulk imports are checked before they touch the disk  
+    return bool(_CHAT_ID_RE.match(chat_id or ""))  
+  
 def _chat_dir(chat_id: str) -> str:  
-    d = os.path.join(BASE_DIR, chat_id)  
-    os.makedirs(d, exist_ok=True)  
-    return d  
+    # chats/ab/cd/<chat_id>, ab/cd from a hash of the id, so no directory grows past a few hundred entries.  
+    # Only write paths create it; reads of unknown chats leave the disk untouched  
+    h = hashlib.sha1(chat_id.encode("utf-8")).hexdigest()  
+    return os.path.join(CHATS_DIR, h[:2], h[2:4], chat_id)  
+  
+def _legacy_dir(chat_id: str) -> str:  
+    # pre-sharding layout: rp_data/<chat_id>  
+    return os.path.join(BASE_DIR, chat_id)  
   
 def _state_file(chat_id: str) -> str:  
     return os.path.join(_chat_dir(chat_id), "state.json")  
   
-def load_state(chat_id: str) -> Dict[str, Any]:  
-    p = _state_file(chat_id)  
+def _meta_file(chat_id: str) -> str:  
+    return os.path.join(_chat_dir(chat_id), "meta.json")  
+  
+def _log_file(chat_id: str) -> str:  
+    return os.path.join(_chat_dir(chat_id), "messages.jsonl")  
+  
+def _session_file(chat_id: str, model: str) -> str:  
+    # provider-side conversation state (Ollama's KV context, thousands of token ids), one file per model, kept out of  
+    # meta.json so it is not rewritten with every metadata save  
+    return os.path.join(_chat_dir(chat_id), "sessions", hashlib.sha1(model.encode("utf-8")).hexdigest()[:16] + ".json")  
+  
+def _default_state(chat_id: str) -> Dict[str, Any]:  
+    return {"chat_id": chat_id, "model": "Vanilla", "intro": "", "personality": "", "welcome": "", "tags": [], "gender": "neutral", "wallpaper": None, "messages": [], "meta": {}}  
+  
+def _default_meta(chat_id: str) -> Dict[str, Any]:  
+    return {k: v for k, v in _default_state(chat_id).items() if k != "messages"}  
+  
+_shard_lock = threading.Lock()  
+  
+def _makedirs(d: str) -> None:  
+    # archive_idle removes shard directories that it emptied; holding this lock keeps it from removing chats/ab/cd  
+    # between makedirs creating that and creating the chat directory inside it  
+    with _shard_lock:  
+        os.makedirs(d, exist_ok=True)  
+  
+def _prune_shards(d: str) -> None:  
+    # after a chat directory is deleted, drop its chats/ab/cd and chats/ab parents if nothing else lives there  
+    parent = os.path.dirname(d)  
+    with _shard_lock:  
+        while parent != CHATS_DIR:  
+            try:  
+                os.rmdir(parent)  
+            except OSError:  
+                break  
+            parent = os.path.dirname(parent)  
+  
+def _write_json_atomic(path: str, data: Any, indent: Optional[int] = 2) -> None:  
+    _makedirs(os.path.dirname(path))  
+    tmp = path + ".tmp"  
+    payload = json.dumps(data, ensure_ascii=False, indent=indent).encode("utf-8")  
+    with open(tmp, "wb") as f:  
+        f.write(payload)  
+    os.replace(tmp, path)  
+    record_storage("write", len(payload))  
+  
+def _read_log(chat_id: str) -> List[Dict[str, Any]]:  
+    p = _log_file(chat_id)  
     if not os.path.exists(p):  
-        st = {"chat_id": chat_id, "model": "Vanilla", "intro": "", "personality": "", "welcome": "", "tags": [], "gender": "neutral", "wallpaper": None, "messages": [], "meta": {}}  
-        save_state(chat_id, st)  
-        return st  
+        return []  
+    messages = []  
     with open(p, "r", encoding="utf-8") as f:  
-        return json.load(f)  
+        record_storage("read", os.fstat(f.fileno()).st_size)  
+        for line in f:  
+            line = line.strip()  
+            if not line:  
+                continue  
+            try:  
+                messages.append(json.loads(line))  
+            except ValueError:  
+                # a torn final record from a crash mid-append; the rest of the log is intact  
+                continue  
+    return messages  
+  
+def _repair_tail(f) -> None:  
+    # f is the log opened "a+b". A record not ending in a newline is the torn tail of a crashed append; drop it (or  
+    # terminate it, if it is somehow complete) so the next record starts on its own line instead of joining it  
+    end = f.seek(0, os.SEEK_END)  
+    if not end:  
+        return  
+    f.seek(end - 1)  
+    if f.read(1) == b"\n":  
+        return  
+    start = end  
+    while start > 0:  
+        step = min(4096, start)  
+        f.seek(start - step)  
+        i = f.read(step).rfind(b"\n")  
+        start -= step  
+        if i >= 0:  
+            start += i + 1  
+            break  
+    f.seek(start)  
+    tail = f.read()  
+    try:  
+        json.loads(tail)  
+    except ValueError:  
+        logger.warning("Dropping torn %d-byte record at the end of %s", len(tail), f.name)  
+        f.truncate(start)  
+    else:  
+        f.write(b"\n")  
+  
+def _write_log(chat_id: str, messages: List[Dict[str, Any]]) -> None:  
+    p = _log_file(chat_id)  
+    _makedirs(os.path.dirname(p))  
+    tmp = p + ".tmp"  
+    payload = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode("utf-8")  
+    with open(tmp, "wb") as f:  
+        f.write(payload)  
+    os.replace(tmp, p)  
+    record_storage("write", len(payload))  
+  
+def _compact_log(chat_id: str) -> int:  
+    messages = _read_log(chat_id)[-MAX_MESSAGES:]  
+    _write_log(chat_id, messages)  
+    return len(messages)  
+  
+def migrate_legacy_state(chat_id: str) -> bool:  
+    legacy = _state_file(chat_id)  
+    if not os.path.exists(legacy) or os.path.exists(_meta_file(chat_id)):  
+        return False  
+    with open(legacy, "r", encoding="utf-8") as f:  
+        st = json.load(f)  
+    messages = st.pop("messages", [])[-MAX_MESSAGES:]  
+    # log first, then meta: a crash in between leaves state.json in place and the migration simply reruns  
+    _write_log(chat_id, messages)  
+    _write_json_atomic(_meta_file(chat_id), st)  
+    os.replace(legacy, legacy + ".migrated")  
+    return True  
+  
+def _legacy_chat_ids() -> List[str]:  
+    return [name for name in sorted(os.listdir(BASE_DIR)) if os.path.isfile(os.path.join(BASE_DIR, name, "meta.json")) or os.path.isfile(os.path.join(BASE_DIR, name, "state.json"))]  
+  
+def _sharded_chat_dirs() -> List[Tuple[str, str]]:  
+    found = []  
+    for level1 in sorted(os.listdir(CHATS_DIR)) if os.path.isdir(CHATS_DIR) else []:  
+        for level2 in sorted(os.listdir(os.path.join(CHATS_DIR, level1))):  
+            parent = os.path.join(CHATS_DIR, level1, level2)  
+            found.extend((name, os.path.join(parent, name)) for name in sorted(os.listdir(parent)))  
+    return found  
+  
+def migrate_all() -> int:  
+    migrated = 0  
+    for name in _legacy_chat_ids():  
+        with _chat_lock(name):  
+            _restore(name)  
+            if migrate_legacy_state(name):  
+                migrated += 1  
+    return migrated  
+  
+def new_message(role: str, content: str, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:  
+    return {"id": str(uuid.uuid4()), "role": role, "content": content, "time": datetime.now(timezone.utc).isoformat(), "meta": meta or {}}  
+  
+def _find_message(messages: List[Dict[str, Any]], msg_id: str) -> Optional[int]:  
+    # cursors are almost always near the tail, so search from the end  
+    for i in range(len(messages) - 1, -1, -1):  
+        if messages[i].get("id") == msg_id:  
+            return i  
+    return None  
+  
+def page_messages(messages: List[Dict[str, Any]], since: Optional[str] = None, before: Optional[str] = None, limit: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:  
+    # since: messages after that id, oldest first; before: the newest `limit` messages older than it.  
+    # an unknown since id (trimmed out of the window) returns the latest page flagged reset so the client resyncs  
+    info = {"last_id": messages[-1].get("id") if messages else None, "has_more": False, "reset": False}  
+    if since is not None:  
+        i = _find_message(messages, since)  
+        if i is not None:  
+            page = messages[i + 1:]  
+            if limit is not None and len(page) > limit:  
+                page, info["has_more"] = page[:limit], True  
+            return page, info  
+        info["reset"] = True  
+    end = len(messages)  
+    if before is not None:  
+        i = _find_message(messages, before)  
+        end = i if i is not None else 0  
+    page = messages[:end]  
+    if limit is not None and len(page) > limit:  
+        page, info["has_more"] = page[-limit:], True  
+    return page, info  
+  
+_chat_locks = [threading.RLock() for _ in range(64)]  
+  
+def _chat_lock(chat_id: str) -> threading.RLock:  
+    # striped per-chat locks: the archiver moves whole chat directories, so every file-level operation on a chat holds one  
+    return _chat_locks[hash(chat_id) % len(_chat_locks)]  
+  
+archive = ChatArchive(ARCHIVE_DIR, ARCHIVE_SEGMENT_BYTES)  
+  
+def _last_active(d: str) -> float:  
+    return max((e.stat().st_mtime for e in os.scandir(d) if e.is_file()), default=0.0)  
+  
+def _restore(chat_id: str, rehydrate: bool = True) -> bool:  
+    # makes sure a chat that exists anywhere is in its shard directory: moved from the flat layout, or rehydrated from  
+    # the archive with its old mtimes, so reading a cold chat does not count as activity. False for unknown chats  
+    d = _chat_dir(chat_id)  
+    if os.path.isdir(d):  
+        return True  
+    legacy = _legacy_dir(chat_id)  
+    if os.path.isfile(os.path.join(legacy, "meta.json")) or os.path.isfile(os.path.join(legacy, "state.json")):  
+        _makedirs(os.path.dirname(d))  
+        os.replace(legacy, d)  
+        return True  
+    found = archive.load(chat_id) if rehydrate else None  
+    if found is None:  
+        return False  
+    record, last_active = found  
+    _write_log(chat_id, record["messages"])  
+    _write_json_atomic(_meta_file(chat_id), record["meta"])  
+    for p in (_log_file(chat_id), _meta_file(chat_id)):  
+        os.utime(p, (last_active, last_active))  
+    archive.drop(chat_id)  
+    logger.info("Rehydrated archived chat %s", chat_id)  
+    return True  
+  
+class FileStorage:  
+    # one directory per chat; safe for a single process only (state_cache serializes access per chat)  
+    shared = False  
+  
+    def _ensure_chat(self, chat_id: str) -> None:  
+        _restore(chat_id)  
+        migrate_legacy_state(chat_id)  
+        if not os.path.exists(_meta_file(chat_id)):  
+            self.save_state(chat_id, _default_state(chat_id))  
+  
+    def load_state(self, chat_id: str, rehydrate: bool = True) -> Dict[str, Any]:  
+        with _chat_lock(chat_id):  
+            if not _restore(chat_id, rehydrate):  
+                found = None if rehydrate else archive.load(chat_id)  
+                if found is None:  
+                    return _default_state(chat_id)  
+                record = found[0]  
+                return {**record["meta"], "messages": record["messages"][-MAX_MESSAGES:]}  
+            migrate_legacy_state(chat_id)  
+            p = _meta_file(chat_id)  
+            if not os.path.exists(p):  
+                return _default_state(chat_id)  
+            with open(p, "rb") as f:  
+                raw = f.read()  
+            record_storage("read", len(raw))  
+            st = json.loads(raw)  
+            messages = _read_log(chat_id)  
+            if len(messages) > COMPACT_THRESHOLD:  
+                messages = messages[-MAX_MESSAGES:]  
+                _write_log(chat_id, messages)  
+            st["messages"] = messages[-MAX_MESSAGES:]  
+            return st  
+  
+    def read_state(self, chat_id: str) -> Dict[str, Any]:  
+        # for bulk readers: an archived chat is read in place and stays archived  
+        return self.load_state(chat_id, rehydrate=False)  
+  
+    def load_meta(self, chat_id: str) -> Dict[str, Any]:  
+        # everything but the messages; the log is not read  
+        with _chat_lock(chat_id):  
+            if not _restore(chat_id, rehydrate=False):  
+                found = archive.load(chat_id)  
+                return found[0]["meta"] if found else _default_meta(chat_id)  
+            migrate_legacy_state(chat_id)  
+            p = _meta_file(chat_id)  
+            if not os.path.exists(p):  
+                return _default_meta(chat_id)  
+            with open(p, "rb") as f:  
+                raw = f.read()  
+            record_storage("read", len(raw))  
+            return json.loads(raw)  
+  
+    def load_page(self, chat_id: str, since: Optional[str] = None, before: Optional[str] = None, limit: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:  
+        st = self.load_state(chat_id)  
+        st["messages"], info = page_messages(st["messages"], since, before, limit)  
+        return st, info  
+  
+    def save_state(self, chat_id: str, state: Dict[str, Any]) -> None:  
+        # messages are owned by the append-only log; only the small metadata file is rewritten  
+        with _chat_lock(chat_id):  
+            _restore(chat_id)  
+            _write_json_atomic(_meta_file(chat_id), {k: v for k, v in state.items() if k != "messages"})  
+  
+    def update_state(self, chat_id: str, fn: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:  
+        with _chat_lock(chat_id):  
+            st = self.load_state(chat_id)  
+            fn(st)  
+            self.save_state(chat_id, st)  
+            return st  
+  
+    def append_messages(self, chat_id: str, messages: List[Dict[str, Any]]) -> None:  
+        payload = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode("utf-8")  
+        with _chat_lock(chat_id):  
+            self._ensure_chat(chat_id)  
+            with open(_log_file(chat_id), "a+b") as f:  
+                _repair_tail(f)  
+                f.write(payload)  
+        record_storage("append", len(payload))  
+  
+    def load_session(self, chat_id: str, model: str) -> Dict[str, Any]:  
+        with _chat_lock(chat_id):  
+            try:  
+                with open(_session_file(chat_id, model), "rb") as f:  
+                    raw = f.read()  
+            except FileNotFoundError:  
+                return {}  
+        record_storage("read", len(raw))  
+        return json.loads(raw)  
+  
+    def save_session(self, chat_id: str, model: str, session: Dict[str, Any]) -> None:  
+        with _chat_lock(chat_id):  
+            # the chat just had a turn, so an archived copy comes back first rather than being hidden by a new directory  
+            _restore(chat_id)  
+            _write_json_atomic(_session_file(chat_id, model), session, indent=None)  
+  
+    def compact_log(self, chat_id: str) -> int:  
+        with _chat_lock(chat_id):  
+            # archived chats are already compact; leave them cold  
+            return _compact_log(chat_id) if _restore(chat_id, rehydrate=False) else 0  
+  
+    def chat_ids(self) -> List[str]:  
+        live = [name for name, d in _sharded_chat_dirs() if os.path.isfile(os.path.join(d, "meta.json"))]  
+        return sorted(set(live) | set(_legacy_chat_ids()) | set(archive.chat_ids()))  
+  
+    def import_chat(self, chat_id: str, state: Dict[str, Any]) -> None:  
+        with _chat_lock(chat_id):  
+            _restore(chat_id)  
+            migrate_legacy_state(chat_id)  
+            _write_log(chat_id, state.get("messages", [])[-MAX_MESSAGES:])  
+            self.save_state(chat_id, state)  
+  
+def _sqlite_storage(path: Optional[str] = None):  
+    from sqlite_storage import SqliteStorage  
+    return SqliteStorage(path or SQLITE_PATH, _default_state, MAX_MESSAGES, COMPACT_THRESHOLD)  
+  
+def _make_backend():  
+    if STORAGE_BACKEND == "file":  
+        return FileStorage()  
+    if STORAGE_BACKEND == "sqlite":  
+        return _sqlite_storage()  
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")  
+  
+backend = _make_backend()  
+  
+def load_state(chat_id: str) -> Dict[str, Any]:  
+    return backend.load_state(chat_id)  
+  
+def load_meta(chat_id: str) -> Dict[str, Any]:  
+    return backend.load_meta(chat_id)  
+  
+def read_state(chat_id: str) -> Dict[str, Any]:  
+    # load_state for bulk reads (export, copy-to-sqlite) that must not pull every archived chat back into a live directory  
+    return backend.read_state(chat_id)  
+  
+def load_page(chat_id: str, since: Optional[str] = None, before: Optional[str] = None, limit: Optional[int] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:  
+    return backend.load_page(chat_id, since, before, limit)  
   
 def save_state(chat_id: str, state: Dict[str, Any]) -> None:  
-    with open(_state_file(chat_id), "w", encoding="utf-8") as f:  
-        json.dump(state, f, ensure_ascii=False, indent=2)  
+    backend.save_state(chat_id, state)  
+  
+def update_state(chat_id: str, fn: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:  
+    return backend.update_state(chat_id, fn)  
+  
+def append_messages(chat_id: str, messages: List[Dict[str, Any]]) -> None:  
+    backend.append_messages(chat_id, messages)  
   
 def append_message(chat_id: str, role: str, content: str, meta: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:  
-    st = load_state(chat_id)  
-    m = {"id": str(uuid.uuid4()), "role": role, "content": content, "time": datetime.now(timezone.utc).isoformat(), "meta": meta or {}}  
-    st["messages"].append(m)  
-    st["messages"] = st["messages"][-400:]  
-    save_state(chat_id, st)  
+    m = new_message(role, content, meta)  
+    append_messages(chat_id, [m])  
     return m  
   
+def load_session(chat_id: str, model: str) -> Dict[str, Any]:  
+    return backend.load_session(chat_id, model)  
+  
+def save_session(chat_id: str, model: str, session: Dict[str, Any]) -> None:  
+    backend.save_session(chat_id, model, session)  
+  
+def compact_log(chat_id: str) -> int:  
+    return backend.compact_log(chat_id)  
+  
+def list_chats() -> List[str]:  
+    return backend.chat_ids()  
+  
+def import_chat(chat_id: str, state: Dict[str, Any]) -> None:  
+    backend.import_chat(chat_id, state)  
+  
+def copy_to_sqlite(path: Optional[str] = None) -> int:  
+    dest, source = _sqlite_storage(path), FileStorage()  
+    migrate_all()  
+    chat_ids = source.chat_ids()  
+    for chat_id in chat_ids:  
+        dest.import_chat(chat_id, source.read_state(chat_id))  
+    return len(chat_ids)  
+  
+def archive_idle(now: Optional[float] = None) -> Dict[str, int]:  
+    # one archiver pass (file backend): delete chats idle past RP_RETENTION_DAYS, pack chats idle past  
+    # RP_ARCHIVE_AFTER_DAYS into archive segments, then rewrite segments that are mostly dead space  
+    now = now or time.time()  
+    stats = {"archived": 0, "deleted": 0, "reclaimed_bytes": 0}  
+    retention = RETENTION_DAYS * 86400  
+    if retention:  
+        stats["deleted"] += archive.expire(now - retention)  
+    migrate_all()  
+    for chat_id, d in _sharded_chat_dirs():  
+        with _chat_lock(chat_id):  
+            if not os.path.isdir(d):  
+                continue  
+            last_active = _last_active(d)  
+            idle = now - last_active  
+            if retention and idle > retention:  
+                shutil.rmtree(d)  
+                _prune_shards(d)  
+                stats["deleted"] += 1  
+            elif ARCHIVE_AFTER_DAYS and idle > ARCHIVE_AFTER_DAYS * 86400:  
+                p = _meta_file(chat_id)  
+                if os.path.exists(p):  
+                    with open(p, "r", encoding="utf-8") as f:  
+                        meta = json.load(f)  
+                else:  
+                    meta = _default_meta(chat_id)  
+                archive.put(chat_id, {"meta": meta, "messages": _read_log(chat_id)[-MAX_MESSAGES:]}, last_active)  
+                shutil.rmtree(d)  
+                _prune_shards(d)  
+                stats["archived"] += 1  
+    stats["reclaimed_bytes"] = archive.reclaim()  
+    return stats  
+  
+_archiver: Optional[threading.Thread] = None  
+_archiver_stop = threading.Event()  
+  
+def start_archiver(interval: float = ARCHIVE_INTERVAL) -> None:  
+    # SQLite keeps its own history bounded, so the archiver only runs for the file backend  
+    global _archiver  
+    if _archiver is not None or not isinstance(backend, FileStorage) or interval <= 0 or not (ARCHIVE_AFTER_DAYS or RETENTION_DAYS):  
+        return  
+    def run() -> None:  
+        while not _archiver_stop.wait(interval):  
+            try:  
+                stats = archive_idle()  
+                if any(stats.values()):  
+                    logger.info("Archiver pass: %s", stats)  
+            except Exception:  
+                logger.exception("Archiver pass failed")  
+    _archiver = threading.Thread(target=run, name="chat-archiver", daemon=True)  
+    _archiver.start()  
+  
+def stop_archiver() -> None:  
+    _archiver_stop.set()  
+  
 def get_chat_dir(chat_id: str) -> str:  
-    return _chat_dir(chat_id)
\ No newline at end of file
+    d = _chat_dir(chat_id)  
+    with _chat_lock(chat_id):  
+        _restore(chat_id)  
+        _makedirs(d)  
+    return d  
+  
+if __name__ == "__main__":  
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""  
+    if cmd == "migrate":  
+        print(f"migrated {migrate_all()} chat(s) from state.json to meta.json + messages.jsonl")  
+    elif cmd == "compact":  
+        for name in backend.chat_ids():  
+            print(f"{name}: {compact_log(name)} message(s)")  
+    elif cmd == "archive":  
+        print(f"archiver pass: {archive_idle()}")  
+    elif cmd == "copy-to-sqlite":  
+        print(f"copied {copy_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else None)} chat(s) into SQLite")  
+    else:  
+        print("usage: python storage.py [migrate|compact|archive|copy-to-sqlite [db path]]")  
+        sys.exit(2)
\ No newline at end of file
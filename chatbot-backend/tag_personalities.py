@@ -1,4 +1,24 @@
-from typing import List
+from typing import List, NamedTuple, Iterable
+
+from config_watch import WatchedConfig, str_list
+
+DEFAULT_TAGS = ["Flirty", "Romantic", "Dominant", "Submissive", "Seductive", "Taboo", "Dark Romance", "Tsundere", "Yandere", "Bratty", "Demon", "Cold"]
+
+_tags = WatchedConfig("tags.json", DEFAULT_TAGS, str_list)
+
+def get_tags() -> List[str]:
+    return _tags.get()
+
+class TagFlags(NamedTuple):
+    taboo_or_dark: bool
+    flirty_or_seductive: bool
+    cold: bool
+    yandere: bool
+    tsundere: bool
+
+def tag_flags(tags: Iterable[str]) -> TagFlags:
+    t = set(tags or ())
+    return TagFlags(taboo_or_dark=bool(t & {"Taboo", "Dark Romance"}), flirty_or_seductive=bool(t & {"Flirty", "Seductive"}), cold="Cold" in t, yandere="Yandere" in t, tsundere="Tsundere" in t)
 
 def build_tag_behavior(tags: List[str]) -> str:
     behavior_lines = []
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# the backend modules are imported top-level (as server.py does); point storage at a scratch directory first
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("RP_DATA_DIR", tempfile.mkdtemp(prefix="emochi-tests-"))
@@ -0,0 +1,69 @@
+import os
+import time
+import json
+import threading
+
+import storage
+import batch
+from archive import ChatArchive
+
+def age(chat_id, days):
+    old = time.time() - days * 86400
+    d = storage._chat_dir(chat_id)
+    for name in os.listdir(d):
+        os.utime(os.path.join(d, name), (old, old))
+
+def test_export_reads_archived_chats_in_place():
+    ids = [f"cold{i}" for i in range(3)]
+    for chat_id in ids:
+        storage.append_message(chat_id, "user", f"hello {chat_id}")
+        age(chat_id, 40)
+    storage.archive_idle()
+    assert set(ids) <= set(storage.archive.chat_ids())
+    exported = {r["chat_id"]: r for r in map(json.loads, batch.export_chats(ids))}
+    assert [exported[c]["state"]["messages"][0]["content"] for c in ids] == [f"hello {c}" for c in ids]
+    # still archived: no live directories came back
+    assert set(ids) <= set(storage.archive.chat_ids())
+    assert not any(os.path.isdir(storage._chat_dir(c)) for c in ids)
+    # a normal read still rehydrates
+    assert storage.load_state("cold0")["messages"][0]["content"] == "hello cold0"
+    assert os.path.isdir(storage._chat_dir("cold0")) and "cold0" not in storage.archive.chat_ids()
+
+def test_reclaim_keeps_members_and_does_not_block_loads(tmp_path):
+    a = ChatArchive(str(tmp_path), segment_bytes=2048)
+    for i in range(40):
+        a.put(f"c{i}", {"meta": {"n": i}, "messages": [{"content": os.urandom(64).hex()}]}, last_active=i)
+    for i in range(0, 40, 3):
+        a.drop(f"c{i}")
+    kept = {c: a.load(c)[0] for c in a.chat_ids()}
+    loads = []
+    stop = threading.Event()
+    def reader():
+        while not stop.is_set():
+            loads.append(a.load("c1")[0]["meta"]["n"])
+    t = threading.Thread(target=reader)
+    t.start()
+    try:
+        freed = a.reclaim(min_live_ratio=0.9, batch=2)
+    finally:
+        stop.set()
+        t.join()
+    assert freed > 0
+    assert {c: a.load(c)[0] for c in a.chat_ids()} == kept
+    assert loads and set(loads) == {1}
+
+def test_archiving_removes_emptied_shard_directories():
+    # "quiet" and a neighbour share chats/ab/ but not chats/ab/cd/
+    h = lambda c: storage._chat_dir(c).split(os.sep)[-3:-1]
+    neighbour = next(c for c in (f"n{i}" for i in range(10000)) if h(c)[0] == h("quiet")[0] and h(c)[1] != h("quiet")[1])
+    for chat_id in ("quiet", neighbour):
+        storage.append_message(chat_id, "user", "hi")
+    age("quiet", 40)
+    shard = os.path.dirname(storage._chat_dir("quiet"))
+    storage.archive_idle()
+    assert not os.path.exists(shard)
+    assert os.path.isdir(storage._chat_dir(neighbour))
+    age(neighbour, 40)
+    storage.archive_idle()
+    assert not os.path.exists(os.path.dirname(shard))
+    assert storage.load_state("quiet")["messages"][0]["content"] == "hi"
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+from blob_store import BlobTooLarge, MalformedUpload, multipart_file
+
+def part(name, body, filename=None):
+    disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename is not None else "")
+    return f"--bb\r\nContent-Disposition: {disposition}\r\nContent-Type: image/png\r\n\r\n".encode() + body + b"\r\n"
+
+def collect(chunks, **kwargs):
+    async def body():
+        for c in chunks:
+            yield c
+    async def go():
+        found = {}
+        data = b"".join([c async for c in multipart_file(body(), "multipart/form-data; boundary=bb", found, **kwargs)])
+        return found, data
+    return asyncio.run(go())
+
+def test_extracts_the_file_field_across_chunk_boundaries():
+    raw = part("note", b"hello") + part("file", b"\x89PNG" + bytes(range(256)) * 40, "wall.png") + b"--bb--\r\n"
+    found, data = collect([raw[i:i + 100] for i in range(0, len(raw), 100)])
+    assert found == {"filename": "wall.png"} and data == b"\x89PNG" + bytes(range(256)) * 40
+
+def test_missing_or_plain_file_field():
+    with pytest.raises(MalformedUpload):
+        collect([part("file", b"just text") + b"--bb--\r\n"])
+    with pytest.raises(MalformedUpload):
+        collect([b"not multipart at all"])
+
+def test_stops_reading_once_the_body_passes_the_limit():
+    read = []
+    def chunks():
+        yield part("file", b"", "big.png")[:-2]
+        for i in range(100):
+            read.append(i)
+            yield b"\0" * 1000
+    with pytest.raises(BlobTooLarge):
+        collect(chunks(), max_bytes=5000)
+    assert len(read) < 10
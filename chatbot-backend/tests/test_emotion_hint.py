@@ -0,0 +1,26 @@
+from emotion_hint import TRIGGERS, score_triggers, score_triggers_batch
+
+def nonzero(scores):
+    return {k: v for k, v in scores.items() if v}
+
+def test_phrases_match_whole_words_only():
+    # the old substring scan also counted "no" in "know"/"not" and "hot" in "shot"/"hotel"
+    assert nonzero(score_triggers("I know you're not alone.")) == {"sad": 1}
+    assert nonzero(score_triggers("She took a shot at the hotel bar.")) == {}
+    assert nonzero(score_triggers("Don't... please stop, I'm scared")) == {"fear": 6}
+    assert nonzero(score_triggers("*whispers* what do you mean—explain")) == {"curiosity": 7}
+
+def test_each_phrase_counts_once_and_case_is_ignored():
+    assert nonzero(score_triggers("NO. No, no.")) == {"fear": 1}
+    assert score_triggers("") == score_triggers(None) == dict.fromkeys(TRIGGERS, 0)
+
+def test_overlapping_phrases_all_count():
+    assert nonzero(score_triggers("With who? Who is that?!")) == {"jealousy": 5}
+    assert nonzero(score_triggers("are you with who is that")) == {"jealousy": 9}
+    assert nonzero(score_triggers("I like you wish")) == {"affection": 2, "tease": 2}
+
+def test_batch_matches_single_messages():
+    texts = ["like", "you", "I miss you", "", None, "screw you, you wish", "no\x00no"]
+    assert score_triggers_batch(texts) == [score_triggers(t) for t in texts]
+    # a phrase split across two messages matches in neither
+    assert nonzero(score_triggers_batch(["like", "you"])[0]) == {}
@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from idempotency import RequestCoalescer, IdempotencyConflict
+
+def test_retries_replay_ok_replies_but_not_fallbacks():
+    async def go():
+        c = RequestCoalescer(ttl=60)
+        calls = []
+        def reply(outcome):
+            async def factory():
+                calls.append(outcome)
+                await asyncio.sleep(0)
+                return {"reply": f"#{len(calls)}", "outcome": outcome}
+            return factory
+        # concurrent duplicates share one generation
+        first, second = await asyncio.gather(c.run(("chat", "k1"), "fp", reply("ok")), c.run(("chat", "k1"), "fp", reply("ok")))
+        assert first == second == {"reply": "#1", "outcome": "ok"}
+        assert (await c.run(("chat", "k1"), "fp", reply("ok")))["reply"] == "#1"
+        with pytest.raises(IdempotencyConflict):
+            await c.run(("chat", "k1"), "other", reply("ok"))
+        # a degraded reply is returned once; the retry generates again
+        assert (await c.run(("chat", "k2"), "fp", reply("fallback")))["reply"] == "#2"
+        assert (await c.run(("chat", "k2"), "fp", reply("ok")))["reply"] == "#3"
+        assert calls == ["ok", "fallback", "ok"]
+    asyncio.run(go())
@@ -0,0 +1,16 @@
+import metrics
+
+def test_model_label():
+    assert metrics.model_label("gpt-4o") == "gpt-4o"
+    assert metrics.model_label(None) == ""
+    assert metrics.model_label("made-up-model") == "other"
+    metrics.add_model_source(lambda: {"Persona": "ollama"})
+    assert metrics.model_label("Persona") == "Persona"
+
+def test_client_model_names_do_not_grow_series():
+    for i in range(50):
+        with metrics.provider_span("ollama", f"hint-{i}"):
+            pass
+        metrics.record_tokens("ollama", f"hint-{i}", 10, 5)
+    models = {key[1] for key in metrics.PROVIDER_SECONDS._values} | {key[1] for key in metrics.PROVIDER_TOKENS._values}
+    assert not any(m.startswith("hint-") for m in models) and "other" in models
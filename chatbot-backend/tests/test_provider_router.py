@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from provider_router import ProviderRouter, parse_models
+
+def test_parse_models():
+    assert parse_models("OpenAI=gpt-4o, ollama = llama3,bad") == {"openai": "gpt-4o", "ollama": "llama3"}
+
+def test_failover_uses_fallback_model():
+    calls = []
+    async def invoke(provider, model):
+        calls.append((provider, model))
+        if provider == "ollama":
+            raise RuntimeError("down")
+        return f"{provider}:{model}"
+    router = ProviderRouter(["ollama", "openai", "emergent"], hedge=False, fallback_models={"openai": "gpt-4o"})
+    assert asyncio.run(router.call("ollama", "llama3", invoke)) == "openai:gpt-4o"
+    assert calls == [("ollama", "llama3"), ("openai", "gpt-4o")]
+    # health is kept under the model that was actually called
+    assert set(router.health) == {("ollama", "llama3"), ("openai", "gpt-4o")}
+
+def test_unknown_models_share_one_health_entry():
+    async def invoke(provider, model):
+        return "ok"
+    router = ProviderRouter(["ollama"], hedge=False)
+    for i in range(20):
+        asyncio.run(router.call("ollama", f"random-{i}", invoke))
+    assert set(router.health) == {("ollama", "other")}
+
+def test_primary_keeps_requested_model():
+    async def invoke(provider, model):
+        return f"{provider}:{model}"
+    router = ProviderRouter(["ollama", "openai"], hedge=False, fallback_models={"openai": "gpt-4o"})
+    assert asyncio.run(router.call("openai", "gpt-4o-mini", invoke)) == "openai:gpt-4o-mini"
+
+def test_stream_failover_uses_fallback_model():
+    def open_stream(provider, model):
+        async def gen():
+            if provider == "ollama":
+                raise RuntimeError("down")
+            yield f"{provider}:{model}"
+        return gen()
+    async def go():
+        router = ProviderRouter(["ollama", "openai"], hedge=False, fallback_models={})
+        return [chunk async for chunk in router.stream("ollama", "llama3", open_stream)]
+    assert asyncio.run(go()) == ["openai:None"]
+
+def test_all_failed():
+    async def invoke(provider, model):
+        raise RuntimeError(f"{provider} down")
+    router = ProviderRouter(["ollama", "openai"], hedge=False)
+    with pytest.raises(RuntimeError, match="All providers failed"):
+        asyncio.run(router.call("ollama", "llama3", invoke))
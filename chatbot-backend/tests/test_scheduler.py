@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from scheduler import Scheduler, Overloaded, parse_limits
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_parse_limits():
+    assert parse_limits("Ollama=2, openai=8,,bad,ollama/llama3=0") == {"ollama": 2, "openai": 8, "ollama/llama3": 1}
+
+def test_model_limit_does_not_block_other_models():
+    async def go():
+        s = Scheduler({"ollama": 2}, {"ollama/llama3": 1}, queue_timeout=1)
+        await s.acquire("ollama", "llama3", "a")
+        b = asyncio.create_task(s.acquire("ollama", "llama3", "b"))
+        await settle()
+        assert not b.done()
+        # a free provider slot and a different model: must start at once, not wait behind b
+        await asyncio.wait_for(s.acquire("ollama", "mistral", "c"), 0.1)
+        assert s.snapshot()["ollama"] == {"running": 2, "queued": 1, "limit": 2, "chats_waiting": 1}
+        s.release("ollama", "mistral", "c")
+        # the freed slot still cannot go to b while llama3 is at its limit
+        await settle()
+        assert not b.done()
+        s.release("ollama", "llama3", "a")
+        await asyncio.wait_for(b, 0.1)
+        s.release("ollama", "llama3", "b")
+        assert s.snapshot()["ollama"]["running"] == 0
+    run(go())
+
+def test_round_robin_across_chats():
+    async def go():
+        s = Scheduler({"ollama": 1}, {}, queue_timeout=1, max_per_chat=0)
+        order = []
+        async def turn(chat_id, n):
+            await s.acquire("ollama", "m", chat_id)
+            order.append(f"{chat_id}{n}")
+            await asyncio.sleep(0)
+            s.release("ollama", "m", chat_id)
+        await s.acquire("ollama", "m", "first")
+        tasks = [asyncio.create_task(turn("busy", i)) for i in range(3)]
+        await settle()
+        tasks.append(asyncio.create_task(turn("quiet", 0)))
+        await settle()
+        s.release("ollama", "m", "first")
+        await asyncio.gather(*tasks)
+        # the quiet chat queued last but is served right after busy's first turn
+        assert order == ["busy0", "quiet0", "busy1", "busy2"]
+    run(go())
+
+def test_rejections():
+    async def go():
+        s = Scheduler({"ollama": 1}, {}, queue_size=1, queue_timeout=0.05, max_per_chat=2)
+        await s.acquire("ollama", "m", "a")
+        queued = asyncio.create_task(s.acquire("ollama", "m", "b"))
+        await settle()
+        with pytest.raises(Overloaded) as full:
+            await s.acquire("ollama", "m", "c")
+        assert full.value.status == 503 and full.value.retry_after >= 1
+        with pytest.raises(Overloaded) as timed_out:
+            await queued
+        assert timed_out.value.status == 503
+        s.check("ollama", "m", "a")
+        waiting = asyncio.create_task(s.acquire("ollama", "m", "a"))
+        await settle()
+        with pytest.raises(Overloaded) as per_chat:
+            s.check("ollama", "m", "a")
+        assert per_chat.value.status == 429
+        s.release("ollama", "m", "a")
+        await asyncio.wait_for(waiting, 0.1)
+        s.release("ollama", "m", "a")
+        assert s.snapshot()["ollama"] == {"running": 0, "queued": 0, "limit": 1, "chats_waiting": 0}
+    run(go())
+
+def test_cancelled_waiter_frees_its_place():
+    async def go():
+        s = Scheduler({"ollama": 1}, {}, queue_timeout=1)
+        await s.acquire("ollama", "m", "a")
+        waiter = asyncio.create_task(s.acquire("ollama", "m", "b"))
+        await settle()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        s.release("ollama", "m", "a")
+        assert s.snapshot()["ollama"] == {"running": 0, "queued": 0, "limit": 1, "chats_waiting": 0}
+    run(go())
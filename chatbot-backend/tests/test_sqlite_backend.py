@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import subprocess
+import textwrap
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the backend is chosen when storage is imported, so each scenario runs in its own interpreter
+def run_script(tmp_path, code, *args):
+    env = {**os.environ, "STORAGE_BACKEND": "sqlite", "STORAGE_SQLITE_PATH": str(tmp_path / "emochi.db"), "RP_DATA_DIR": str(tmp_path), "PYTHONPATH": BACKEND_DIR}
+    return subprocess.Popen([sys.executable, "-c", textwrap.dedent(code), *args], env=env, stdout=subprocess.PIPE, text=True)
+
+WORKER = """
+    import sys
+    import storage
+    worker, n = sys.argv[1], int(sys.argv[2])
+    def bump(st):
+        st["counter"] = st.get("counter", 0) + 1
+    for i in range(n):
+        storage.append_message("shared", "user", f"{worker}:{i}")
+        storage.update_state("shared", bump)
+"""
+
+def test_workers_do_not_lose_updates(tmp_path):
+    workers, per_worker = 6, 60
+    procs = [run_script(tmp_path, WORKER, str(w), str(per_worker)) for w in range(workers)]
+    assert all(p.wait(timeout=120) == 0 for p in procs)
+    check = run_script(tmp_path, """
+        import json, storage
+        st = storage.load_state("shared")
+        print(json.dumps({"counter": st["counter"], "messages": [m["content"] for m in st["messages"]], "ids": len({m["id"] for m in st["messages"]})}))
+    """)
+    out, _ = check.communicate(timeout=60)
+    result = json.loads(out)
+    assert result["counter"] == workers * per_worker
+    assert len(result["messages"]) == result["ids"] == workers * per_worker
+    for w in range(workers):
+        # each worker's messages are all there, in the order it wrote them
+        assert [m for m in result["messages"] if m.startswith(f"{w}:")] == [f"{w}:{i}" for i in range(per_worker)]
+
+def test_write_lock_wait_does_not_block_the_event_loop(tmp_path):
+    # another connection holds the write lock for a second; the event loop must keep running meanwhile
+    proc = run_script(tmp_path, """
+        import time, asyncio, sqlite3, threading
+        import storage, state_cache
+        storage.append_message("busy", "user", "hi")
+        held = threading.Event()
+        def hold():
+            db = sqlite3.connect(storage.SQLITE_PATH, isolation_level=None)
+            db.execute("BEGIN IMMEDIATE")
+            held.set()
+            time.sleep(1.0)
+            db.execute("COMMIT")
+        threading.Thread(target=hold).start()
+        held.wait()
+        async def main():
+            ticks = 0
+            write = asyncio.ensure_future(state_cache.offload(state_cache.update_state, "busy", lambda st: st.update(seen=True)))
+            while not write.done():
+                ticks += 1
+                await asyncio.sleep(0.01)
+            await write
+            print(ticks, storage.load_meta("busy")["seen"])
+        asyncio.run(main())
+    """)
+    out, _ = proc.communicate(timeout=60)
+    ticks, seen = out.split()
+    assert int(ticks) > 20 and seen == "True"
+
+def test_turn_is_committed_before_the_reply_returns(tmp_path):
+    # another worker may serve the chat's next turn, so the reply and emotion state must be in the database already
+    proc = run_script(tmp_path, """
+        import json, asyncio
+        import rp_engine, storage
+        async def fake_llm(*args, **kwargs):
+            return "hello there"
+        rp_engine.choose_and_call = fake_llm
+        async def main():
+            await rp_engine.generate_reply("handoff", "hi")
+            st = storage.load_state("handoff")
+            print(json.dumps({"roles": [m["role"] for m in st["messages"]], "hint": "last_emotion_hint" in st}))
+        asyncio.run(main())
+    """)
+    out, _ = proc.communicate(timeout=60)
+    assert json.loads(out) == {"roles": ["user", "assistant"], "hint": True}
+
+def test_provider_sessions_have_their_own_table(tmp_path):
+    proc = run_script(tmp_path, """
+        import json, storage
+        storage.append_message("s", "user", "hi")
+        storage.save_session("s", "Vanilla", {"context": [1, 2, 3]})
+        storage.save_session("s", "Vanilla", {"context": [4, 5]})
+        print(json.dumps([storage.load_session("s", "Vanilla"), storage.load_session("s", "Peach"), "provider_session" in storage.load_meta("s")]))
+    """)
+    out, _ = proc.communicate(timeout=60)
+    assert json.loads(out) == [{"context": [4, 5]}, {}, False]
+
+def test_stream_reply_is_stored_once(tmp_path):
+    # finishing the turn fails after the reply was stored; a disconnect mid-stream stores the partial reply
+    proc = run_script(tmp_path, """
+        import json, asyncio
+        import rp_engine, storage
+        async def fake_stream(*args, **kwargs):
+            for word in ("hello ", "there"):
+                yield word
+        rp_engine.choose_and_stream = fake_stream
+        finish, calls = rp_engine._finish_turn, []
+        async def failing_finish(*args, **kwargs):
+            calls.append(args[4])
+            await finish(*args, **kwargs)
+            raise RuntimeError("after the reply was stored")
+        async def main():
+            rp_engine._finish_turn = failing_finish
+            try:
+                async for event in rp_engine.stream_reply("late", "hi"):
+                    pass
+            except RuntimeError:
+                pass
+            rp_engine._finish_turn = finish
+            stream = rp_engine.stream_reply("gone", "hi")
+            await stream.__anext__()
+            await stream.aclose()
+            print(json.dumps([calls, [m["role"] for m in storage.load_state("late")["messages"]], [m["role"] for m in storage.load_state("gone")["messages"]]]))
+        asyncio.run(main())
+    """)
+    out, _ = proc.communicate(timeout=60)
+    assert json.loads(out) == [["hello there"], ["user", "assistant"], ["user", "assistant"]]
@@ -0,0 +1,43 @@
+import time
+import asyncio
+import threading
+
+import storage
+import state_cache
+from state_cache import StateCache
+
+def test_offload_runs_storage_calls_off_the_event_loop():
+    # a cache miss reads the chat from disk under its lock; that must not stall other requests
+    calls = []
+    def load(chat_id):
+        calls.append(threading.get_ident())
+        return state_cache.load_state(chat_id)
+    async def main():
+        st = await state_cache.offload(load, "offload-miss")
+        return threading.get_ident(), st
+    loop_thread, st = asyncio.run(main())
+    assert calls and calls[0] != loop_thread
+    assert st["messages"] == []
+
+def test_eviction_hands_dirty_chats_to_the_flusher(monkeypatch):
+    writers = []
+    real_append = storage.append_messages
+    def append_messages(chat_id, messages):
+        writers.append(threading.current_thread().name)
+        real_append(chat_id, messages)
+    monkeypatch.setattr(storage, "append_messages", append_messages)
+    cache = StateCache(max_entries=1, flush_interval=60)
+    try:
+        cache.append_message("evict-a", "user", "kept")
+        # loading another chat evicts the first on this thread, but its unwritten message is not written here
+        cache.get_state("evict-b")
+        assert "MainThread" not in writers
+        assert [m["content"] for m in cache.get_state("evict-a")["messages"]] == ["kept"]
+        cache.get_state("evict-b")
+        deadline = time.monotonic() + 5
+        while cache._retired and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not cache._retired and writers == ["state-cache-flusher"]
+        assert [m["content"] for m in storage.load_state("evict-a")["messages"]] == ["kept"]
+    finally:
+        cache.shutdown()
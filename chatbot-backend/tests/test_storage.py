@@ -0,0 +1,53 @@
+import os
+
+import storage
+
+def contents(chat_id):
+    return [m["content"] for m in storage.FileStorage().load_state(chat_id)["messages"]]
+
+def test_append_after_torn_record():
+    fs = storage.FileStorage()
+    fs.append_messages("torn", [storage.new_message("user", "one")])
+    with open(storage._log_file("torn"), "ab") as f:
+        f.write(b'{"id": "x", "role": "user", "cont')
+    fs.append_messages("torn", [storage.new_message("user", "two")])
+    fs.append_messages("torn", [storage.new_message("user", "three")])
+    assert contents("torn") == ["one", "two", "three"]
+
+def test_append_after_unterminated_complete_record():
+    fs = storage.FileStorage()
+    fs.append_messages("unterminated", [storage.new_message("user", "one")])
+    with open(storage._log_file("unterminated"), "rb+") as f:
+        f.truncate(os.path.getsize(storage._log_file("unterminated")) - 1)
+    fs.append_messages("unterminated", [storage.new_message("user", "two")])
+    assert contents("unterminated") == ["one", "two"]
+
+def test_torn_only_record():
+    fs = storage.FileStorage()
+    fs.save_state("fresh", storage._default_state("fresh"))
+    with open(storage._log_file("fresh"), "wb") as f:
+        f.write(b'{"broken')
+    fs.append_messages("fresh", [storage.new_message("user", "one")])
+    assert contents("fresh") == ["one"]
+
+def test_load_meta_skips_messages():
+    fs = storage.FileStorage()
+    fs.append_messages("meta-only", [storage.new_message("user", "one")])
+    fs.update_state("meta-only", lambda st: st.update(model="Peach"))
+    meta = fs.load_meta("meta-only")
+    assert meta["model"] == "Peach" and "messages" not in meta
+    assert fs.load_meta("never-seen")["model"] == "Vanilla"
+    assert not os.path.exists(storage._chat_dir("never-seen"))
+
+def test_provider_sessions_are_kept_apart_from_metadata():
+    fs = storage.FileStorage()
+    fs.append_messages("sessions", [storage.new_message("user", "one")])
+    fs.save_session("sessions", "Vanilla", {"context": list(range(4096)), "model": "llama3"})
+    fs.save_session("sessions", "Peach", {"context": [1, 2, 3]})
+    assert fs.load_session("sessions", "Vanilla")["context"] == list(range(4096))
+    assert fs.load_session("sessions", "Peach") == {"context": [1, 2, 3]}
+    assert fs.load_session("sessions", "Strawberry") == {}
+    # saving metadata does not touch them, and they are not part of it
+    fs.update_state("sessions", lambda st: st.update(model="Peach"))
+    assert "provider_session" not in fs.load_meta("sessions")
+    assert fs.load_session("sessions", "Peach") == {"context": [1, 2, 3]}